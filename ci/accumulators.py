@@ -0,0 +1,288 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Online accumulation of the probes of non-deterministic backends : each
+# repetition is folded into per-probe buffers as soon as it is read, so the
+# memory used by vfc_ci test stays proportional to the number of probes (and
+# not to the number of intermediate dataframes).
+
+import numpy as np
+import pandas as pd
+
+from .test_data_processing import deduplicate
+
+# Magic numbers
+initial_capacity = 1024  # Initial number of probes that can be stored
+initial_samples = 16  # Initial number of samples per probe that can be stored
+chunk_size = 4096  # Number of probes sorted at once when exporting samples
+
+
+##########################################################################
+
+class ProbesAccumulator:
+    '''
+    Accumulate the samples of every probe (identified by its test, variable
+    and backend). Each repetition is identified by a slot number, and the
+    values of a probe are stored in the order in which repetitions are added
+    in a preallocated (probes x samples) float64 matrix, along with their
+    slots, so they can be sorted in the slot order at the end.
+    '''
+
+    def __init__(self, n_samples=initial_samples):
+        self.size = 0
+
+        # For each backend, the index of its probes, the matching rows, and
+        # the probes order of its last repetition (with their rows)
+        self.indexes = {}
+
+        self.tests = []
+        self.variables = []
+        self.backends = []
+
+        self.samples = np.empty((0, n_samples), dtype=np.float64)
+        self.slots = np.empty((0, n_samples), dtype=np.int32)
+
+        self.count = np.zeros(0, dtype=np.int64)
+
+        # The check of a probe is the one of its first slot
+        self.accuracy_threshold = np.zeros(0)
+        self.check_mode = np.empty(0, dtype=object)
+        self.check_slot = np.zeros(0, dtype=np.int64)
+
+    def reserve(self, size, n_samples=0):
+        '''
+        Grow all buffers (by doubling them) so they can hold size probes, with
+        n_samples samples each
+        '''
+
+        capacity = len(self.count)
+        samples_capacity = self.samples.shape[1]
+        if size <= capacity and n_samples <= samples_capacity:
+            return
+
+        if size > capacity:
+            capacity = max(size, 2 * capacity, initial_capacity)
+        if n_samples > samples_capacity:
+            samples_capacity = max(n_samples, 2 * samples_capacity)
+
+        def grow(array, fill):
+            grown = np.full(
+                (capacity, samples_capacity)[:array.ndim],
+                fill,
+                dtype=array.dtype
+            )
+            used = (slice(0, self.size),) + \
+                tuple(slice(0, n) for n in array.shape[1:])
+            grown[used] = array[:self.size]
+            return grown
+
+        self.samples = grow(self.samples, 0)
+        self.slots = grow(self.slots, 0)
+
+        self.count = grow(self.count, 0)
+
+        self.accuracy_threshold = grow(self.accuracy_threshold, 0)
+        self.check_mode = grow(self.check_mode, None)
+        self.check_slot = grow(self.check_slot, np.iinfo(np.int64).max)
+
+    def get_rows(self, backend, tests, variables):
+        '''
+        Return the rows of the probes of a backend, and create the ones that
+        haven't been seen yet
+        '''
+
+        # Probes are identified by a single string so they can be looked up
+        # with a flat index
+        keys = np.asarray(tests, dtype=object) + "\0" + \
+            np.asarray(variables, dtype=object)
+
+        if backend not in self.indexes:
+            self.indexes[backend] = (
+                pd.Index([], dtype=object),
+                np.empty(0, dtype=np.int64),
+                None,
+                None
+            )
+        index, rows, last_keys, last_rows = self.indexes[backend]
+
+        # Repetitions usually dump their probes in the same order
+        if last_keys is not None and np.array_equal(keys, last_keys):
+            return last_rows
+
+        positions = index.get_indexer(keys)
+        new = positions == -1
+
+        if new.any():
+            n_new = np.count_nonzero(new)
+            positions[new] = len(index) + np.arange(n_new)
+
+            new_rows = np.arange(self.size, self.size + n_new)
+            self.reserve(self.size + n_new)
+            self.size += n_new
+
+            self.tests.extend(np.asarray(tests)[new])
+            self.variables.extend(np.asarray(variables)[new])
+            self.backends.extend([backend] * n_new)
+
+            index = index.append(pd.Index(keys[new], dtype=object))
+            rows = np.concatenate([rows, new_rows])
+
+        self.indexes[backend] = (index, rows, keys, rows[positions])
+
+        return rows[positions]
+
+    def add(self, slot, backend, tests, variables, values,
+            accuracy_threshold, check_mode):
+        '''
+        Fold the probes of one repetition (identified by slot), and return
+        their rows
+        '''
+
+        if len(values) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        values = np.asarray(values, dtype=np.float64)
+        rows = self.get_rows(backend, tests, variables)
+
+        columns = self.count[rows]
+        self.reserve(self.size, columns.max() + 1)
+        self.samples[rows, columns] = values
+        self.slots[rows, columns] = slot
+        self.count[rows] += 1
+
+        earlier = slot < self.check_slot[rows]
+        self.accuracy_threshold[rows[earlier]] = \
+            np.asarray(accuracy_threshold, dtype=np.float64)[earlier]
+        self.check_mode[rows[earlier]] = np.asarray(check_mode)[earlier]
+        self.check_slot[rows[earlier]] = slot
+
+        return rows
+
+    def get_samples(self, rows):
+        '''Return the samples of some rows (in the order they were added)'''
+
+        return [self.samples[row, :self.count[row]] for row in rows]
+
+    def sorted_samples(self, rows, ranks=None):
+        '''
+        Return the samples of some rows as a matrix, with the samples of each
+        row sorted according to the ranks of their slots (ranks[slot]), or to
+        the slots themselves if no ranks are given, and their sorted ranks.
+        Unused samples are at the end of each row.
+        '''
+
+        count = self.count[rows]
+
+        order = self.slots[rows].astype(np.int64)
+        if ranks is not None:
+            order = ranks[order]
+
+        # Unused samples are moved at the end of their rows
+        unused = np.arange(order.shape[1]) >= count[:, np.newaxis]
+        order[unused] = np.iinfo(np.int64).max
+
+        indices = np.argsort(order, axis=1, kind="stable")
+        samples = np.take_along_axis(self.samples[rows], indices, axis=1)
+        order = np.take_along_axis(order, indices, axis=1)
+
+        return samples, order
+
+    def to_dataframe(self, ranks=None, with_ranks=False, with_values=True):
+        '''
+        Return the accumulated probes as a dataframe indexed by test,
+        variable and backend, with the samples of each probe in the values
+        column (sorted as in sorted_samples). If with_ranks is set, the sorted
+        ranks of the samples are also returned in the ranks column. Without
+        with_values, the samples are left out (see group_samples), and the
+        accumulator row of each probe is given in the row column instead.
+        '''
+
+        if self.size == 0:
+            return pd.DataFrame()
+
+        if ranks is not None:
+            ranks = np.asarray(ranks, dtype=np.int64)
+
+        data = pd.DataFrame({
+            "test": self.tests,
+            "variable": self.variables,
+            "vfc_backend": self.backends,
+            "accuracy_threshold": self.accuracy_threshold[:self.size],
+            "check_mode": self.check_mode[:self.size]
+        })
+
+        if not with_values:
+            data.insert(3, "row", np.arange(self.size))
+            return data.set_index(
+                ["test", "variable", "vfc_backend"]).sort_index()
+
+        values = np.empty(self.size, dtype=object)
+        sample_ranks = np.empty(self.size, dtype=object)
+
+        # Rows are sorted by chunks, so only small temporary arrays are needed
+        for start in range(0, self.size, chunk_size):
+            stop = min(start + chunk_size, self.size)
+            count = self.count[start:stop]
+            samples, order = self.sorted_samples(
+                np.arange(start, stop), ranks)
+
+            for row in range(stop - start):
+                values[start + row] = samples[row, :count[row]]
+                if with_ranks:
+                    sample_ranks[start + row] = order[row, :count[row]]
+
+        data.insert(3, "values", values)
+        if with_ranks:
+            data.insert(4, "ranks", sample_ranks)
+
+        return data.set_index(
+            ["test", "variable", "vfc_backend"]).sort_index()
+
+    def group_samples(self, rows, ranks=None):
+        '''
+        Group the samples of some rows (for instance the row column of
+        to_dataframe) by number of samples, like group_by_nsamples, without
+        copying them to intermediate arrays : each group matrix is filled by
+        chunks of rows directly from the accumulator. Samples are sorted as in
+        sorted_samples.
+        '''
+
+        if ranks is not None:
+            ranks = np.asarray(ranks, dtype=np.int64)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        nsamples = self.count[rows]
+        groups = {}
+
+        for n in np.unique(nsamples):
+            positions = np.flatnonzero(nsamples == n)
+            matrix = np.empty((len(positions), n), dtype=np.float64)
+
+            for start in range(0, len(positions), chunk_size):
+                chunk = positions[start:start + chunk_size]
+                samples, order = self.sorted_samples(rows[chunk], ranks)
+                matrix[start:start + len(chunk)] = samples[:, :n]
+
+            groups[n] = (positions,) + deduplicate(matrix)
+
+        return groups
@@ -0,0 +1,290 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Local content-addressed cache used by vfc_ci test. Files are stored once
+# under the hash of their content (objects directory), and entries (JSON
+# files named after the hash of their key) associate a set of paths to the
+# stored files. Entries are touched when they are used, and the least
+# recently used ones are evicted when the cache exceeds its size.
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+
+from .checkpoint import write_atomically
+
+# Magic numbers
+chunk_size = 2**20  # Size of the blocks read when hashing files
+default_max_size = 2**30  # Default size of the cache (in bytes)
+orphan_delay = 3600  # Age after which files without entries are removed
+
+
+##########################################################################
+
+def cache_directory():
+    '''Root of the cache (follows the XDG base directory specification)'''
+
+    root = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(root, "vfc_ci")
+
+
+def hash_file(path):
+    '''SHA-256 of the content of a file'''
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_key(key):
+    '''SHA-256 of any JSON-serializable key'''
+
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def command_version(command):
+    '''
+    Output of a version command, or None if it can't be executed (it is only
+    used as a part of cache keys)
+    '''
+
+    try:
+        return subprocess.run(
+            command.split(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            check=False
+        ).stdout.decode(errors="replace")
+
+    except OSError:
+        return None
+
+
+def match_inputs(pattern):
+    '''Files matching a glob pattern'''
+
+    return [
+        path for path in glob.glob(pattern, recursive=True)
+        if os.path.isfile(path)
+    ]
+
+
+def unmatched_inputs(patterns):
+    '''Glob patterns of a list that don't match any file'''
+
+    return [pattern for pattern in patterns if len(match_inputs(pattern)) == 0]
+
+
+def hash_inputs(patterns):
+    '''
+    Hashes of all the files matching a list of glob patterns, as a sorted list
+    of (path, hash) pairs
+    '''
+
+    paths = set()
+    for pattern in patterns:
+        paths.update(match_inputs(pattern))
+
+    return [[path, hash_file(path)] for path in sorted(paths)]
+
+
+def linked_libraries(path):
+    '''
+    Paths of the shared libraries an executable is linked to (according to
+    ldd). Returns an empty list if the file isn't a dynamic executable.
+    '''
+
+    try:
+        output = subprocess.run(
+            ["ldd", os.path.abspath(path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False
+        ).stdout.decode(errors="replace")
+
+    except OSError:
+        return []
+
+    libraries = set()
+    for line in output.splitlines():
+        for word in line.split():
+            if word.startswith("/") and os.path.isfile(word):
+                libraries.add(word)
+
+    return sorted(libraries)
+
+
+##########################################################################
+
+    # Storage of files and entries
+
+def object_path(digest):
+    return os.path.join(cache_directory(), "objects", digest[:2], digest)
+
+
+def entry_path(namespace, key):
+    return os.path.join(cache_directory(), namespace, hash_key(key) + ".json")
+
+
+def store_file(path):
+    '''Add a file to the cache and return its hash'''
+
+    digest = hash_file(path)
+    destination = object_path(digest)
+
+    if not os.path.isfile(destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(path, "rb") as source:
+            write_atomically(
+                destination,
+                lambda file: shutil.copyfileobj(source, file)
+            )
+
+    return digest
+
+
+def restore_file(digest, path, mode):
+    '''Copy a file of the cache to path (with the given permissions)'''
+
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
+    with open(object_path(digest), "rb") as source:
+        write_atomically(path, lambda file: shutil.copyfileobj(source, file))
+
+    os.chmod(path, mode)
+
+
+def save_entry(namespace, key, paths, data=None):
+    '''
+    Store a set of files as the entry of a key. Additional (JSON-serializable)
+    data can be associated to the entry.
+    '''
+
+    entry = {
+        "files": [
+            [path, store_file(path), os.stat(path).st_mode & 0o7777]
+            for path in paths
+        ],
+        "data": data
+    }
+
+    path = entry_path(namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomically(path, lambda file: file.write(json.dumps(entry).encode()))
+
+
+def load_entry(namespace, key):
+    '''
+    Return the entry of a key (or None if it isn't in the cache, or if some of
+    its files are missing)
+    '''
+
+    try:
+        with open(entry_path(namespace, key)) as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    for path, digest, mode in entry["files"]:
+        if not os.path.isfile(object_path(digest)):
+            return None
+
+    # The modification time of entries orders them for eviction
+    try:
+        os.utime(entry_path(namespace, key))
+    except OSError:
+        pass
+
+    return entry
+
+
+def prune(max_size=default_max_size):
+    '''
+    Evict the least recently used entries until the files of the remaining
+    ones fit in max_size bytes, and remove the files no entry refers to
+    (unless they are recent : their entry may still be being written)
+    '''
+
+    root = cache_directory()
+    if not os.path.isdir(root):
+        return
+
+    entries = []
+    for namespace in os.listdir(root):
+        if namespace == "objects" or \
+                not os.path.isdir(os.path.join(root, namespace)):
+            continue
+
+        for path in glob.glob(os.path.join(root, namespace, "*.json")):
+            try:
+                with open(path) as file:
+                    digests = [
+                        digest for _, digest, _ in json.load(file)["files"]]
+                entries.append((os.path.getmtime(path), path, digests))
+            except (OSError, ValueError, KeyError):
+                continue
+
+    # Keep the most recent entries, as long as their files fit
+    kept = set()
+    size = 0
+    for mtime, path, digests in sorted(entries, reverse=True):
+        try:
+            added = sum(
+                os.path.getsize(object_path(digest))
+                for digest in set(digests) - kept
+            )
+        except OSError:
+            added = 0
+
+        if size + added <= max_size:
+            kept.update(digests)
+            size += added
+            continue
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    now = time.time()
+    for path in glob.glob(os.path.join(root, "objects", "*", "*")):
+        if os.path.basename(path) in kept:
+            continue
+
+        try:
+            if now - os.path.getmtime(path) > orphan_delay:
+                os.remove(path)
+        except OSError:
+            pass
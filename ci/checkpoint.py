@@ -0,0 +1,202 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Checkpointing of vfc_ci test runs : the probes of every finished job are
+# saved in a directory as soon as they have been read, so an interrupted run
+# can be resumed without executing these jobs again.
+
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+
+# Files written by the checkpoint for each job (job key, see Checkpoint.path),
+# and temporary files of write_atomically
+saved_file = re.compile(
+    r"^((non_deterministic|deterministic|reference)(--?[0-9]+){3}"
+    r"\.(csv|json)|tmp\w{8})$"
+)
+
+
+##########################################################################
+
+def write_atomically(path, write):
+    '''
+    Write a file through a temporary file of the same directory, which is
+    then renamed. The file is either complete or absent, even if the process
+    is killed in the middle of the write.
+    '''
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write(file)
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class Checkpoint:
+    '''
+    A directory containing the probes (CSV files) of the finished jobs of a
+    run, along with the config of this run and the result cache keys of its
+    executables (which identify their binaries). A job is considered
+    checkpointed once its metadata file (written after its probes) exists.
+    The directory is recognized by its checkpoint.json file, and only the
+    files written by the checkpoint are ever removed from it.
+    '''
+
+    def __init__(self, directory, resume):
+        self.directory = directory
+        self.resume = resume
+        self.marker_path = os.path.join(directory, "checkpoint.json")
+
+        # Make sure that no unrelated files will be removed
+        assert not os.path.exists(directory) or os.path.isdir(directory) \
+            and (len(os.listdir(directory)) == 0
+                 or os.path.isfile(self.marker_path)), \
+            "Error [vfc_ci]: The checkpoint directory %s already exists and " \
+            "isn't a checkpoint. Please specify an empty or new directory " \
+            "with --checkpoint-directory." % directory
+
+    def start(self, config, cache_keys):
+        '''
+        Resume the checkpoint if it was requested and if it has been written
+        with the same config and binaries (given by the result cache keys of
+        their backends, see get_cache_keys). Otherwise, the checkpoint is
+        cleared.
+        '''
+
+        description = {
+            "config": config,
+            "cache_keys": sorted(
+                [list(position), key] for position, key in cache_keys.items()
+            )
+        }
+
+        if self.resume:
+            try:
+                with open(self.marker_path) as file:
+                    saved = json.load(file)
+            except (OSError, ValueError):
+                saved = None
+
+            if saved == description:
+                return
+
+            if saved is not None and saved.get("config") == config:
+                print(
+                    "Warning [vfc_ci]: The executables have changed since the "
+                    "checkpoint in %s was written, the run will start from "
+                    "scratch" % self.directory,
+                    file=sys.stderr
+                )
+            else:
+                print(
+                    "Warning [vfc_ci]: No checkpoint matching the current "
+                    "tests config was found in %s, the run will start from "
+                    "scratch" % self.directory,
+                    file=sys.stderr
+                )
+
+        self.clear()
+        os.makedirs(self.directory, exist_ok=True)
+
+        write_atomically(
+            self.marker_path,
+            lambda file: file.write(json.dumps(description).encode())
+        )
+
+    def path(self, key):
+        '''Path of the checkpoint of a job (without extension)'''
+
+        return os.path.join(self.directory, "-".join(str(x) for x in key))
+
+    def save(self, job):
+        '''Save the probes and duration of a finished job'''
+
+        path = self.path(job.key)
+
+        with open(job.output_path, "rb") as probes:
+            write_atomically(
+                path + ".csv",
+                lambda file: shutil.copyfileobj(probes, file)
+            )
+
+        write_atomically(
+            path + ".json",
+            lambda file: file.write(
+                json.dumps({"duration": job.duration}).encode())
+        )
+
+    def saved(self, key):
+        '''Return True if the job of this key has been checkpointed'''
+
+        return os.path.isfile(self.path(key) + ".json")
+
+    def restore(self, job):
+        '''
+        If a job has been checkpointed, point its output to the saved probes
+        and restore its duration. Returns False if the job has to be run.
+        '''
+
+        path = self.path(job.key)
+
+        try:
+            with open(path + ".json") as file:
+                job.duration = json.load(file)["duration"]
+        except (OSError, ValueError, KeyError):
+            return False
+
+        job.output_path = path + ".csv"
+        return True
+
+    def clear(self):
+        '''
+        Remove the files written by the checkpoint : its description, the
+        probes and metadata of jobs, and leftover temporary files
+        '''
+
+        if not os.path.isfile(self.marker_path):
+            return
+
+        for name in os.listdir(self.directory):
+            if saved_file.match(name):
+                os.remove(os.path.join(self.directory, name))
+
+        os.remove(self.marker_path)
+
+    def remove(self):
+        '''Delete the checkpoint once the run is complete'''
+
+        self.clear()
+
+        # The directory is only removed if nothing else has been written to it
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
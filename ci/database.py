@@ -0,0 +1,186 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Optional history database : a single SQLite file to which vfc_ci test
+# appends the metadata, statistics and deterministic data of every run, as
+# an alternative to reading all run files. It contains 3 tables :
+# - runs : the metadata of runs (one row per run, indexed by timestamp and
+#   by remote_url/branch)
+# - probes : the metrics of non-deterministic probes
+# - deterministic_probes : the values and checks of deterministic probes
+# Probes are indexed by (test, variable, vfc_backend, timestamp) and by
+# timestamp, so the history of one probe or the probes of one run are index
+# lookups.
+
+import sqlite3
+
+import pandas as pd
+
+tables = {
+    "metadata": "runs",
+    "data": "probes",
+    "deterministic_data": "deterministic_probes"
+}
+
+indexes = {
+    "runs": [["remote_url", "branch", "timestamp"]],
+    "probes": [
+        ["test", "variable", "vfc_backend", "timestamp"],
+        ["timestamp"]
+    ],
+    "deterministic_probes": [
+        ["test", "variable", "vfc_backend", "timestamp"],
+        ["timestamp"]
+    ]
+}
+
+# Columns stored as integers, which are converted back to booleans
+boolean_columns = ["is_git_commit", "check"]
+
+
+##########################################################################
+
+def get_type(dtype):
+    '''SQLite type of a column'''
+
+    if pd.api.types.is_bool_dtype(dtype) or \
+            pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def table_exists(connection, table):
+    return connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table,)
+    ).fetchone() is not None
+
+
+def prepare_table(connection, table, frame):
+    '''
+    Create a table (and its indexes) from the columns of a dataframe, or add
+    the columns of the dataframe it doesn't have yet
+    '''
+
+    existing = [
+        row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)
+    ]
+
+    if len(existing) == 0:
+        columns = [
+            "\"%s\" %s" % (column, get_type(frame[column].dtype))
+            for column in frame.columns
+        ]
+        if table == "runs":
+            columns[list(frame.columns).index("timestamp")] += " PRIMARY KEY"
+
+        connection.execute(
+            "CREATE TABLE %s (%s)" % (table, ", ".join(columns)))
+
+    else:
+        for column in frame.columns:
+            if column not in existing:
+                connection.execute(
+                    "ALTER TABLE %s ADD COLUMN \"%s\" %s"
+                    % (table, column, get_type(frame[column].dtype)))
+
+    for columns in indexes[table]:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)"
+            % (table, "_".join(columns), table, ", ".join(columns)))
+
+
+def append_run(path, metadata, data, deterministic_data):
+    '''
+    Append a run (as exported in a run file, with its timestamp as the index
+    of its metadata) to the database. A run with the same timestamp is
+    replaced, as its run file would be.
+    '''
+
+    frames = {
+        "metadata": metadata,
+        "data": data,
+        "deterministic_data": deterministic_data
+    }
+    timestamp = int(metadata.index[0])
+
+    connection = sqlite3.connect(path)
+
+    # Everything is written in one transaction, so the database never
+    # contains partial runs
+    with connection:
+        for key, frame in frames.items():
+            table = tables[key]
+
+            # The replaced run may have rows in tables this run leaves empty
+            if table_exists(connection, table):
+                connection.execute(
+                    "DELETE FROM %s WHERE timestamp = ?" % table, (timestamp,))
+
+            if frame.empty:
+                continue
+
+            frame = frame.reset_index()
+            if "values" in frame.columns:
+                frame = frame.drop(columns="values")
+
+            prepare_table(connection, table, frame)
+            frame.to_sql(table, connection, if_exists="append", index=False)
+
+    connection.close()
+
+
+def read_table(connection, key, columns=None, query="", parameters=()):
+    '''
+    Read the rows of a table matching a query (WHERE/ORDER BY/LIMIT clauses)
+    as a dataframe indexed like the tables of run files. As in run files, only
+    the requested columns are read (the index is always read), and columns
+    that aren't in the table are ignored.
+    '''
+
+    table = tables[key]
+    names = [
+        row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)
+    ]
+    if len(names) == 0:
+        return pd.DataFrame()
+
+    index = ["timestamp"] if key == "metadata" else \
+        ["test", "variable", "vfc_backend"]
+    if columns is not None:
+        names = index + [column for column in columns if column in names]
+
+    frame = pd.read_sql_query(
+        "SELECT %s FROM %s %s"
+        % (", ".join("\"%s\"" % name for name in names), table, query),
+        connection,
+        params=parameters
+    )
+
+    for column in boolean_columns:
+        if column in frame.columns:
+            frame[column] = frame[column].astype(bool)
+
+    return frame.set_index(index)
@@ -0,0 +1,529 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Distributed execution of vfc_ci test through a work queue stored in a
+# shared directory. The coordinator (vfc_ci test --distributed) publishes
+# jobs, and workers (vfc_ci worker), possibly running on other machines
+# sharing this directory, claim and run them. The queue directory contains :
+# - pending/<job id>.json : jobs waiting for a worker
+# - claimed/<worker id>/<job id>.json : jobs being run by a worker (claimed by
+#   an atomic rename from pending/)
+# - results/<job id>.csv and .json : probes and duration of finished jobs
+#   (the .json file is written last, with the error of the job if it couldn't
+#   be run)
+# - workers/<worker id> : heartbeat files of the workers, touched regularly
+# Jobs claimed by workers that stopped updating their heartbeat are moved
+# back to pending/, up to max_requeues times : after that, they are reported
+# as failed. A requeued job can finish twice (if its first worker was only
+# slow) : only the first result is collected, and the others are deleted.
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import asyncio
+
+from .checkpoint import write_atomically
+from .scheduler import Job, CoreAllocator, execute_job, available_cores
+
+# Magic numbers
+poll_interval = 0.1  # Interval between two scans of the queue (in seconds)
+heartbeat_interval = 2  # Interval between two heartbeats of a worker
+heartbeat_timeout = 30  # Delay after which a silent worker is considered dead
+max_requeues = 2  # Number of times a job can be lost by a worker and run again
+
+
+##########################################################################
+
+def create_queue(directory):
+    '''Create the subdirectories of a queue directory'''
+
+    for subdirectory in ["pending", "claimed", "results", "workers"]:
+        os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+
+def write_json(path, data):
+    write_atomically(path, lambda file: file.write(json.dumps(data).encode()))
+
+
+##########################################################################
+
+# Coordinator
+
+class DistributedScheduler:
+    '''
+    Same interface as Scheduler, but jobs are published to a queue directory
+    instead of being run locally. Jobs are published in submission order, so
+    workers claim them in this order. Only group limits are enforced here
+    (the number of concurrent jobs of each worker is set by the worker).
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        create_queue(directory)
+
+        # Identifies the jobs of this run in the queue
+        self.run_id = uuid.uuid4().hex[:12]
+        self.sequence = 0
+
+        self.limits = {}
+        self.pending = []
+        self.published = {}
+        self.published_by_group = {}
+
+        # Number of times each published job has been requeued
+        self.requeues = {}
+
+        # Jobs that have been collected or abandoned
+        self.finished = set()
+
+    def set_limit(self, group, limit):
+        '''Set the maximum number of concurrent jobs of a group'''
+
+        self.limits[group] = limit
+
+    def submit(self, job):
+        self.pending.append(job)
+
+    def can_start(self, job):
+        limit = self.limits.get(job.group)
+        return limit is None or \
+            self.published_by_group.get(job.group, 0) < limit
+
+    def publish(self, job):
+        # Sequence numbers keep the submission order in the queue
+        job_id = "%s-%08d" % (self.run_id, self.sequence)
+        self.sequence += 1
+
+        description = {
+            "key": list(job.key),
+            "group": job.group,
+            "command": job.command,
+            "backend": job.backend,
+            "timeout": job.timeout,
+            "description": job.description,
+            "threads": job.threads
+        }
+
+        write_json(
+            os.path.join(self.directory, "pending", job_id + ".json"),
+            description
+        )
+
+        self.published[job_id] = job
+        self.published_by_group[job.group] = \
+            self.published_by_group.get(job.group, 0) + 1
+
+    def publish_jobs(self):
+        '''Publish as many pending jobs as the group limits allow'''
+
+        remaining = []
+
+        for job in self.pending:
+            if self.can_start(job):
+                self.publish(job)
+            else:
+                remaining.append(job)
+
+        self.pending = remaining
+
+    def collect_results(self, callback):
+        '''
+        Pass finished jobs to the callback, and return how many there were
+        '''
+
+        results = os.path.join(self.directory, "results")
+        collected = 0
+
+        for job_id in list(self.published.keys()):
+            name = job_id + ".json"
+            path = os.path.join(results, name)
+
+            try:
+                with open(path) as file:
+                    result = json.load(file)
+            except (OSError, ValueError):
+                continue
+
+            if "error" in result:
+                print(
+                    "Warning [vfc_ci]: Worker %s couldn't run %s : %s"
+                    % (result["worker"], self.published[job_id].description,
+                       result["error"]),
+                    file=sys.stderr
+                )
+
+            job = self.published.pop(job_id)
+            self.published_by_group[job.group] -= 1
+            self.requeues.pop(job_id, None)
+            self.finished.add(job_id)
+
+            # A missing probes file is reported as such by the callback
+            job.output_path = os.path.join(results, job_id + ".csv")
+            job.duration = result["duration"]
+
+            callback(job)
+            os.remove(path)
+            collected += 1
+
+            # If the job has been requeued, its copy isn't needed anymore
+            try:
+                os.remove(os.path.join(self.directory, "pending", name))
+            except OSError:
+                pass
+
+        return collected
+
+    def remove_duplicates(self, complete=False):
+        '''
+        Delete the results of jobs that have already been collected or
+        abandoned. Probes are only deleted with their result (which is written
+        last), unless complete is True.
+        '''
+
+        results = os.path.join(self.directory, "results")
+
+        for name in os.listdir(results):
+            job_id, extension = os.path.splitext(name)
+            if job_id not in self.finished or \
+                    (extension != ".json" and not complete):
+                continue
+
+            for path in [os.path.join(results, job_id + ".json"),
+                         os.path.join(results, job_id + ".csv")]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def abandon(self, job_id, callback):
+        '''
+        Report a job that has been lost by too many workers as failed (with no
+        probes and no duration)
+        '''
+
+        job = self.published.pop(job_id)
+        self.published_by_group[job.group] -= 1
+        self.requeues.pop(job_id)
+        self.finished.add(job_id)
+
+        print(
+            "Warning [vfc_ci]: %s has been lost by %d workers, it won't be "
+            "run again" % (job.description, max_requeues + 1),
+            file=sys.stderr
+        )
+
+        job.output_path = os.path.join(
+            self.directory, "results", job_id + ".csv")
+        job.duration = None
+
+        callback(job)
+
+    def requeue_jobs(self, callback):
+        '''
+        Move the jobs claimed by dead workers back to pending/ (or abandon
+        them if they have already been requeued too many times)
+        '''
+
+        claimed = os.path.join(self.directory, "claimed")
+        now = time.time()
+
+        for worker_id in os.listdir(claimed):
+            try:
+                heartbeat = os.path.getmtime(
+                    os.path.join(self.directory, "workers", worker_id))
+            except OSError:
+                heartbeat = 0
+
+            if now - heartbeat < heartbeat_timeout:
+                continue
+
+            worker_directory = os.path.join(claimed, worker_id)
+            for name in os.listdir(worker_directory):
+                job_id = name[:-5]
+                if job_id not in self.published:
+                    continue
+
+                if self.requeues.get(job_id, 0) >= max_requeues:
+                    try:
+                        os.remove(os.path.join(worker_directory, name))
+                    except OSError:
+                        continue
+                    self.abandon(job_id, callback)
+                    continue
+
+                print(
+                    "Warning [vfc_ci]: Worker %s seems to be dead, its job "
+                    "%s will be run again" % (worker_id, job_id),
+                    file=sys.stderr
+                )
+
+                try:
+                    os.rename(
+                        os.path.join(worker_directory, name),
+                        os.path.join(self.directory, "pending", name)
+                    )
+                except OSError:
+                    continue
+                self.requeues[job_id] = self.requeues.get(job_id, 0) + 1
+
+            # Forget dead workers once all their jobs have been requeued
+            try:
+                os.rmdir(worker_directory)
+                os.remove(os.path.join(self.directory, "workers", worker_id))
+            except OSError:
+                pass
+
+    def has_workers(self):
+        '''Return True if some workers of the queue are alive'''
+
+        workers = os.path.join(self.directory, "workers")
+        now = time.time()
+
+        for worker_id in os.listdir(workers):
+            try:
+                heartbeat = os.path.getmtime(os.path.join(workers, worker_id))
+            except OSError:
+                continue
+
+            if now - heartbeat < heartbeat_timeout:
+                return True
+
+        return False
+
+    def run(self, callback):
+        '''Run all submitted jobs (and those submitted by the callback)'''
+
+        self.publish_jobs()
+
+        # Jobs can't progress without workers, so their absence is reported
+        last_worker = time.monotonic()
+        warned = False
+
+        while len(self.published) > 0 or len(self.pending) > 0:
+            collected = self.collect_results(callback)
+            self.requeue_jobs(callback)
+            self.remove_duplicates()
+            self.publish_jobs()
+
+            if self.has_workers():
+                last_worker = time.monotonic()
+                warned = False
+            elif not warned and \
+                    time.monotonic() - last_worker > heartbeat_timeout:
+                print(
+                    "Warning [vfc_ci]: No worker has been running for %d "
+                    "seconds. Start workers with vfc_ci worker %s."
+                    % (heartbeat_timeout, self.directory),
+                    file=sys.stderr
+                )
+                warned = True
+
+            if collected == 0:
+                time.sleep(poll_interval)
+
+        self.remove_duplicates(complete=True)
+
+
+##########################################################################
+
+# Worker
+
+class Worker:
+    '''
+    Claim jobs from a queue directory and run them (up to max_jobs at the
+    same time, on disjoint sets of cores), until stopped or idle for max_idle
+    seconds
+    '''
+
+    def __init__(self, directory, max_jobs, max_idle=None):
+        self.directory = directory
+        self.max_jobs = max_jobs
+        self.max_idle = max_idle
+
+        self.id = "%s-%s" % (socket.gethostname(), os.getpid())
+        self.claimed = os.path.join(directory, "claimed", self.id)
+        self.heartbeat = os.path.join(directory, "workers", self.id)
+        self.cores = CoreAllocator()
+
+    def beat(self):
+        with open(self.heartbeat, "a"):
+            os.utime(self.heartbeat)
+
+    def claim(self):
+        '''
+        Claim the oldest pending job, and return its id, description and
+        cores, or None if there are not enough free cores for it (later jobs
+        are not claimed instead, so that jobs with many threads get their
+        cores)
+        '''
+
+        pending = os.path.join(self.directory, "pending")
+
+        # The coordinator removes the claimed directory of workers it
+        # believed dead
+        os.makedirs(self.claimed, exist_ok=True)
+
+        for name in sorted(os.listdir(pending)):
+            try:
+                with open(os.path.join(pending, name)) as file:
+                    description = json.load(file)
+            except (OSError, ValueError):
+                continue
+
+            cores = self.cores.allocate(description["threads"])
+            if cores is None:
+                return None
+
+            # Only one worker can succeed in renaming the file
+            try:
+                os.rename(
+                    os.path.join(pending, name),
+                    os.path.join(self.claimed, name)
+                )
+            except OSError:
+                self.cores.release(cores)
+                continue
+
+            return name[:-5], description, cores
+
+        return None
+
+    async def run_job(self, job_id, description, cores):
+        job = Job(
+            tuple(description["key"]),
+            description["group"],
+            description["command"],
+            description["backend"],
+            description["timeout"],
+            description["description"],
+            description["threads"]
+        )
+        job.cores = cores
+
+        result = {"worker": self.id}
+        start = time.monotonic()
+
+        # A job that can't be run is published as failed (without probes),
+        # so that it doesn't stop the worker
+        try:
+            await execute_job(job)
+        except Exception as e:
+            print(
+                "Warning [vfc_ci]: %s couldn't be run : %s"
+                % (job.description, e),
+                file=sys.stderr
+            )
+            result["error"] = str(e)
+
+        result["duration"] = job.duration if job.duration is not None \
+            else time.monotonic() - start
+
+        # Probes are published before the result, which marks the job as
+        # finished
+        results = os.path.join(self.directory, "results")
+        if job.output_path is not None and os.path.isfile(job.output_path):
+            with open(job.output_path, "rb") as probes:
+                write_atomically(
+                    os.path.join(results, job_id + ".csv"),
+                    lambda file: shutil.copyfileobj(probes, file)
+                )
+
+        write_json(os.path.join(results, job_id + ".json"), result)
+
+        # The job may have been requeued if this worker was believed dead
+        try:
+            os.remove(os.path.join(self.claimed, job_id + ".json"))
+        except FileNotFoundError:
+            pass
+
+        job.cleanup()
+        self.cores.release(cores)
+
+    async def work(self):
+        running = set()
+        last_beat = 0
+        last_activity = time.monotonic()
+
+        while True:
+            if time.monotonic() - last_beat > heartbeat_interval:
+                self.beat()
+                last_beat = time.monotonic()
+
+            while len(running) < self.max_jobs and \
+                    len(self.cores.free) > 0:
+                claimed = self.claim()
+                if claimed is None:
+                    break
+                running.add(asyncio.ensure_future(self.run_job(*claimed)))
+
+            if len(running) == 0:
+                if self.max_idle is not None and \
+                        time.monotonic() - last_activity > self.max_idle:
+                    break
+
+                await asyncio.sleep(poll_interval)
+                continue
+
+            done, running = await asyncio.wait(
+                running,
+                timeout=poll_interval,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+
+            last_activity = time.monotonic()
+
+    def run(self):
+        create_queue(self.directory)
+        os.makedirs(self.claimed, exist_ok=True)
+
+        print(
+            "Info [vfc_ci]: Worker %s is waiting for jobs in %s..."
+            % (self.id, self.directory)
+        )
+
+        try:
+            asyncio.run(self.work())
+        finally:
+            # Both may have been removed by a coordinator, and the claimed
+            # directory is only removed if it is empty
+            for remove, path in [(os.remove, self.heartbeat),
+                                 (os.rmdir, self.claimed)]:
+                try:
+                    remove(path)
+                except OSError:
+                    pass
+
+
+def run(directory, jobs, max_idle):
+    '''Entry point of vfc_ci worker'''
+
+    if jobs is None:
+        jobs = available_cores()
+
+    Worker(directory, jobs, max_idle).run()
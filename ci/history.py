@@ -0,0 +1,88 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+
+
+# Helper functions to read the history of previous runs (run files written by
+# vfc_ci test) from a directory. This is used to adapt the execution of new
+# runs to what we know about the previous ones.
+
+import os
+import json
+
+from . import run_files
+
+# Magic numbers
+max_history_files = 20  # Maximum number of previous runs to read
+
+
+##########################################################################
+
+def find_run_files(directory):
+    '''
+    Return the paths of the run files in a directory, most recent (by
+    modification time) first
+    '''
+
+    if not os.path.isdir(directory):
+        return []
+
+    paths = [
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if run_files.is_run_file(f)
+    ]
+
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def read_durations(directory):
+    '''
+    Return the durations of previous executions as a dict of dicts
+    ({executable: {backend: seconds}}). For each (executable, backend), the
+    duration of the most recent run in which it has been recorded is kept.
+    '''
+
+    durations = {}
+
+    for path in find_run_files(directory)[:max_history_files]:
+        try:
+            metadata = run_files.read_table(path, "metadata")
+        except Exception:
+            print(
+                "Warning [vfc_ci]: Could not read the run file %s, it will "
+                "be ignored" % path
+            )
+            continue
+
+        # Durations are not recorded in older run files
+        if "durations" not in metadata.columns:
+            continue
+
+        run_durations = json.loads(metadata.iloc[0]["durations"])
+
+        for executable in run_durations:
+            executable_durations = durations.setdefault(executable, {})
+            for backend, duration in run_durations[executable].items():
+                executable_durations.setdefault(backend, duration)
+
+    return durations
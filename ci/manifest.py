@@ -0,0 +1,242 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Manifest of a directory of run files : a JSON file (vfcruns.manifest.json)
+# summarizing every run file of the directory, so runs can be listed and
+# selected without opening their files. For each run file, it contains the
+# timestamp, hash, branch and remote URL of the run, its number of probes,
+# and the size and modification time of the file. vfc_ci reindex creates or
+# rebuilds it from the run files (for instance after moving them to another
+# directory), and vfc_ci test then updates it each time it writes a run file
+# in this directory. Directories without a manifest (such as the working
+# directory, from which run files are usually moved) are left untouched.
+# The manifest is always replaced atomically, and updates are serialized with
+# a lock file, so runs written concurrently are all recorded.
+
+import os
+import sys
+import json
+import fcntl
+
+from . import run_files
+from .checkpoint import write_atomically
+
+filename = "vfcruns.manifest.json"
+version = 1
+
+# Metadata copied to the manifest entries
+metadata_columns = ["is_git_commit", "hash", "branch", "remote_url"]
+
+
+##########################################################################
+
+def get_path(directory):
+    return os.path.join(directory, filename)
+
+
+def get_size(path):
+    '''Size of a run file (Parquet run files are directories)'''
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(
+        os.path.getsize(os.path.join(path, name))
+        for name in os.listdir(path)
+    )
+
+
+def count_rows(path, key):
+    if path.endswith(run_files.formats["hdf5"]):
+        return len(run_files.read_table(path, key))
+
+    import pyarrow.parquet
+
+    return pyarrow.parquet.read_metadata(
+        os.path.join(path, key + ".parquet")).num_rows
+
+
+def is_current(entry, path):
+    '''
+    Return True if a manifest entry still describes a run file (same size and
+    modification time)
+    '''
+
+    try:
+        return entry["size"] == get_size(path) and \
+            entry["mtime"] == os.path.getmtime(path)
+    except (OSError, KeyError):
+        return False
+
+
+def read(directory):
+    '''
+    Return the entries of the manifest of a directory, as a dict of dicts
+    ({filename: entry}). If there is no manifest (or if it can't be read), the
+    dict is empty.
+    '''
+
+    try:
+        with open(get_path(directory), "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get("version") != version:
+        return {}
+
+    return manifest["runs"]
+
+
+def write(directory, entries):
+    path = get_path(directory)
+    write_atomically(
+        path,
+        lambda file: file.write(json.dumps({
+            "version": version,
+            "runs": entries
+        }, indent=1, sort_keys=True).encode())
+    )
+    os.chmod(path, 0o644)
+
+
+def make_entry(path, metadata, probes, deterministic_probes):
+    '''
+    Manifest entry of a run file, from its metadata (one row dataframe indexed
+    by timestamp) and its number of (deterministic) probes
+    '''
+
+    row = metadata.iloc[0]
+    entry = {
+        "timestamp": int(metadata.index[0]),
+        "probes": int(probes),
+        "deterministic_probes": int(deterministic_probes),
+        "size": get_size(path),
+        "mtime": os.path.getmtime(path)
+    }
+    for column in metadata_columns:
+        value = row[column] if column in row.index else ""
+        entry[column] = bool(value) if column == "is_git_commit" \
+            else str(value)
+
+    return entry
+
+
+def read_entry(path):
+    '''Manifest entry of a run file, read from the file'''
+
+    return make_entry(
+        path,
+        run_files.read_table(path, "metadata"),
+        count_rows(path, "data"),
+        count_rows(path, "deterministic_data")
+    )
+
+
+def update(directory, update_entries):
+    '''
+    Apply update_entries (a function modifying the dict of entries in place)
+    to the manifest of a directory, while holding its lock
+    '''
+
+    # The lock file is hidden, so it isn't committed with the run files
+    with open(os.path.join(directory, "." + filename + ".lock"), "a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            entries = read(directory)
+            update_entries(entries)
+            write(directory, entries)
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def add_run(path, metadata, data, deterministic_data):
+    '''
+    Record a run file that has just been written in the manifest of its
+    directory, if this directory has one
+    '''
+
+    directory = os.path.dirname(path) or "."
+    if not os.path.isfile(get_path(directory)):
+        return
+
+    entry = make_entry(path, metadata, len(data), len(deterministic_data))
+    update(
+        directory,
+        lambda entries: entries.__setitem__(os.path.basename(path), entry)
+    )
+
+
+def reindex(directory, full=False):
+    '''
+    Entry point of vfc_ci reindex. Entries of files that are still present with
+    the same size are kept (unless full is True), so only new or modified
+    run files are read. Entries of removed files are dropped.
+    '''
+
+    assert os.path.isdir(directory), \
+        "Error [vfc_ci]: %s is not a directory." % directory
+
+    counts = {"read": 0, "kept": 0, "removed": 0}
+
+    def update_entries(entries):
+        names = sorted(
+            name for name in os.listdir(directory)
+            if run_files.is_run_file(name)
+        )
+
+        for name in set(entries) - set(names):
+            del entries[name]
+            counts["removed"] += 1
+
+        for name in names:
+            path = os.path.join(directory, name)
+
+            # Run files are never modified in place, and checking out a
+            # repository changes modification times, so only sizes are
+            # compared
+            if not full and name in entries \
+                    and entries[name]["size"] == get_size(path):
+                entries[name]["mtime"] = os.path.getmtime(path)
+                counts["kept"] += 1
+                continue
+
+            try:
+                entries[name] = read_entry(path)
+                counts["read"] += 1
+            except Exception:
+                entries.pop(name, None)
+                print(
+                    "Warning [vfc_ci]: Could not read the run file %s, it "
+                    "will be ignored" % path,
+                    file=sys.stderr
+                )
+
+    update(directory, update_entries)
+
+    print(
+        "Info [vfc_ci]: The manifest %s has been updated (%s run files read, "
+        "%s unchanged, %s removed)."
+        % (get_path(directory), counts["read"], counts["kept"],
+           counts["removed"])
+    )
@@ -0,0 +1,218 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Merge the partial run files of the shards of a run (created with vfc_ci test
+# --shard) into one run file. The samples of each probe are concatenated (in
+# the config order) before computing their statistics, so the result is the
+# same as if the whole run had been executed at once.
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from .test import export_results
+from . import run_files
+
+
+##########################################################################
+
+def read_shards(paths):
+    '''
+    Read the partial run files of all shards, and return their (metadata,
+    data, deterministic_data) sorted by shard index
+    '''
+
+    shards = {}
+
+    for path in paths:
+        metadata = run_files.read_table(path, "metadata").reset_index().iloc[0]
+        assert("shard" in metadata.index), \
+            "Error [vfc_ci]: %s is not the result of a shard" % path
+
+        shard = json.loads(metadata["shard"])
+        assert(shard["index"] not in shards), \
+            "Error [vfc_ci]: Shard %s/%s is given twice" \
+            % (shard["index"], shard["count"])
+
+        shards[shard["index"]] = (
+            shard,
+            metadata,
+            run_files.read_table(path, "data"),
+            run_files.read_table(path, "deterministic_data")
+        )
+
+    descriptions = [shard for shard, _, _, _ in shards.values()]
+    count = descriptions[0]["count"]
+
+    assert(all(
+        description["count"] == count for description in descriptions
+    )), "Error [vfc_ci]: These shards come from different runs (their " \
+        "numbers of shards differ)"
+    assert(all(
+        description["config"] == descriptions[0]["config"]
+        for description in descriptions
+    )), "Error [vfc_ci]: These shards come from different tests configs"
+    assert(all(
+        description["partition"] == descriptions[0]["partition"]
+        for description in descriptions
+    )), "Error [vfc_ci]: These shards have split the executions differently " \
+        "(they must use the same history of previous runs)"
+
+    missing = sorted(set(range(1, count + 1)) - set(shards.keys()))
+    assert(len(missing) == 0), \
+        "Error [vfc_ci]: Missing shards : %s (out of %s)" \
+        % (", ".join(str(index) for index in missing), count)
+
+    return [shards[index][1:] for index in sorted(shards.keys())]
+
+
+def merge_json_column(columns):
+    '''
+    Merge a JSON column of the metadata of all shards. Columns contain dicts
+    by executable of lists (which are concatenated) or of dicts by backend
+    of durations (which are averaged) or lists (which are concatenated).
+    '''
+
+    merged = {}
+    for column in columns:
+        for executable, value in json.loads(column).items():
+            if isinstance(value, list):
+                merged.setdefault(executable, []).append(value)
+                continue
+
+            for backend, backend_value in value.items():
+                merged.setdefault(executable, {}).setdefault(
+                    backend, []).append(backend_value)
+
+    def combine(values):
+        if isinstance(values[0], list):
+            return sorted(set(sum(values, [])))
+        return sum(values) / len(values)
+
+    return {
+        executable: combine(value) if isinstance(value, list) else {
+            backend: combine(values) for backend, values in value.items()
+        }
+        for executable, value in merged.items()
+    }
+
+
+def merge_metadata(metadata):
+    '''
+    The run takes the metadata of the first shard, with the durations, cached
+    backends and tests of all shards
+    '''
+
+    merged = metadata[0].drop("shard").to_dict()
+
+    for column in ["durations", "cached", "tests"]:
+        merged[column] = json.dumps(
+            merge_json_column(shard[column] for shard in metadata))
+
+    return merged
+
+
+def merge_data(data):
+    '''
+    Concatenate the samples of each probe in all shards, in the order of
+    their ranks. Checks are taken from the shard containing the first sample.
+    '''
+
+    data = [shard for shard in data if not shard.empty]
+    if len(data) == 0:
+        return pd.DataFrame()
+
+    data = pd.concat(data)
+
+    # Rows of the same probe are sorted by their first sample
+    first_ranks = np.array([ranks[0] for ranks in data["ranks"]])
+    data = data.iloc[np.argsort(first_ranks, kind="stable")]
+
+    codes, probes = pd.factorize(data.index)
+    counts = data["values"].map(len).to_numpy()
+
+    # All samples are sorted at once, by probe and rank
+    values = np.concatenate(data["values"].to_list())
+    ranks = np.concatenate(data["ranks"].to_list())
+    order = np.lexsort((ranks, np.repeat(codes, counts)))
+
+    sizes = np.bincount(codes, weights=counts, minlength=len(probes))
+    samples = np.empty(len(probes), dtype=object)
+    for i, probe_samples in enumerate(np.split(
+            values[order], np.cumsum(sizes.astype(np.int64))[:-1])):
+        samples[i] = probe_samples
+
+    checks = data[["accuracy_threshold", "check_mode"]].groupby(
+        codes, sort=True).first()
+
+    merged = pd.DataFrame(
+        {
+            "values": samples,
+            "accuracy_threshold": checks["accuracy_threshold"].to_numpy(),
+            "check_mode": checks["check_mode"].to_numpy()
+        },
+        index=pd.MultiIndex.from_tuples(probes, names=data.index.names)
+    )
+
+    return merged.sort_index()
+
+
+def run(
+        paths,
+        export_raw_values,
+        dry_run,
+        processing_jobs=None,
+        file_format="hdf5",
+        compress_raw_values=False,
+        database_path=None):
+    '''Entry point of vfc_ci merge'''
+
+    print("Info [vfc_ci]: Reading %s shards..." % len(paths))
+    shards = read_shards(paths)
+
+    metadata = merge_metadata([shard[0] for shard in shards])
+    data = merge_data([shard[1] for shard in shards])
+
+    deterministic_data = [
+        shard[2] for shard in shards if not shard[2].empty
+    ]
+    if len(deterministic_data) != 0:
+        deterministic_data = pd.concat(
+            deterministic_data,
+            sort=False,
+            ignore_index=True)
+    else:
+        deterministic_data = pd.DataFrame()
+
+    export_results(
+        metadata,
+        data,
+        deterministic_data,
+        export_raw_values,
+        dry_run,
+        processing_jobs,
+        file_format,
+        compress_raw_values,
+        database_path
+    )
@@ -0,0 +1,211 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+
+
+# Vectorized Shapiro-Wilk normality test. This follows the same algorithm
+# (AS R94, with the AS 111 approximation of the normal quantile function) as
+# scipy.stats.shapiro, but tests all the
+# distributions of a (probes x samples) matrix at once. The coefficients only
+# depend on the number of samples, so they are computed once and shared by
+# all probes.
+
+import functools
+import math
+
+import numpy as np
+import scipy.special
+
+# Magic numbers (from AS R94)
+small = 1e-19
+
+g = [-2.273, 0.459]
+c1 = [0.0, 0.221157, -0.147981, -2.07119, 4.434685, -2.706056]
+c2 = [0.0, 0.042981, -0.293762, -1.752461, 5.682633, -3.582633]
+c3 = [0.544, -0.39978, 0.025054, -6.714e-4]
+c4 = [1.3822, -0.77857, 0.062767, -0.0020322]
+c5 = [-1.5861, -0.31082, -0.083751, 0.0038915]
+c6 = [-0.4803, -0.082676, 0.0030302]
+
+pi6 = 1.90985931710274
+stqr = 1.04719755119660
+
+
+##########################################################################
+
+# Helper functions
+
+def poly(c, x):
+    '''Evaluate the polynomial of coefficients c (lowest degree first) in x'''
+
+    result = c[0]
+    if len(c) == 1:
+        return result
+
+    p = x * c[-1]
+    for coefficient in c[-2:0:-1]:
+        p = (p + coefficient) * x
+
+    return result + p
+
+
+def normal_quantile(p):
+    '''Quantile function of the standard normal distribution (AS 111)'''
+
+    q = p - 0.5
+
+    if abs(q) <= 0.42:
+        r = q * q
+        return q * (((-25.44106049637 * r + 41.39119773534) * r
+                     - 18.61500062529) * r + 2.50662823884) \
+            / ((((3.13082909833 * r - 21.06224101826) * r
+                 + 23.08336743743) * r - 8.47351093090) * r + 1.0)
+
+    r = p if q <= 0 else 1.0 - p
+    r = math.sqrt(-math.log(r))
+    value = (((2.32121276858 * r + 4.85014127135) * r
+              - 2.29796479134) * r - 2.78718931138) \
+        / ((1.63706781897 * r + 3.54388924762) * r + 1.0)
+
+    return -value if q < 0 else value
+
+
+@functools.lru_cache(maxsize=None)
+def shapiro_coefficients(n):
+    '''
+    Compute the Shapiro-Wilk coefficients for n samples. Returns the centered
+    coefficients of the sorted samples and the sum of their squares.
+    '''
+
+    n2 = n // 2
+    a = np.zeros(n2)
+
+    if n == 3:
+        a[0] = math.sqrt(0.5)
+
+    else:
+        an25 = n + 0.25
+        m = [normal_quantile((i - 0.375) / an25) for i in range(1, n2 + 1)]
+
+        summ2 = 0.0
+        for value in m:
+            summ2 += value * value
+        summ2 *= 2.0
+        ssumm2 = math.sqrt(summ2)
+        rsn = 1.0 / math.sqrt(n)
+
+        a1 = poly(c1, rsn) - m[0] / ssumm2
+
+        # Normalize a
+        if n > 5:
+            i1 = 3
+            a2 = -m[1] / ssumm2 + poly(c2, rsn)
+            fac = math.sqrt((summ2 - 2.0 * m[0] ** 2 - 2.0 * m[1] ** 2)
+                            / (1.0 - 2.0 * a1 ** 2 - 2.0 * a2 ** 2))
+            a[1] = a2
+        else:
+            i1 = 2
+            fac = math.sqrt((summ2 - 2.0 * m[0] ** 2) / (1.0 - 2.0 * a1 ** 2))
+
+        a[0] = a1
+        for i in range(i1, n2 + 1):
+            a[i - 1] = -m[i - 1] / fac
+
+    # Coefficients of the sorted samples (antisymmetric, 0 in the middle)
+    coefficients = np.zeros(n)
+    coefficients[:n2] = -a
+    coefficients[n - n2:] = a[::-1]
+
+    # Sums are accumulated in the same order as in AS R94
+    sa = 0.0
+    for value in coefficients:
+        sa += value
+    centered = coefficients - sa / n
+
+    ssa = 0.0
+    for value in centered:
+        ssa += value * value
+
+    return centered, ssa
+
+
+##########################################################################
+
+def shapiro_pvalues(distributions):
+    '''
+    Perform the Shapiro-Wilk test on each row of a (probes x samples) matrix,
+    and return the array of p-values. Results are the same as with
+    scipy.stats.shapiro (up to rounding errors).
+    '''
+
+    k, n = distributions.shape
+    if n < 3:
+        raise ValueError("Data must be at least length 3.")
+
+    centered, ssa = shapiro_coefficients(n)
+
+    # Like scipy, subtract a value close to the median to limit rounding
+    # errors
+    x = np.sort(distributions, axis=1) - distributions[:, n // 2][:, None]
+    data_range = x[:, -1] - x[:, 0]
+
+    # Distributions with a null range are considered normal
+    constant = data_range < small
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = x / data_range[:, None]
+
+        # Sums are accumulated sequentially (like in AS R94) with cumsum
+        sx = np.cumsum(scaled, axis=1)[:, -1] / n
+        xsx = scaled - sx[:, None]
+        ssx = np.cumsum(xsx * xsx, axis=1)[:, -1]
+        sax = np.cumsum(centered * xsx, axis=1)[:, -1]
+
+        # w1 equals (1 - w), computed to avoid excessive rounding errors
+        ssassx = np.sqrt(ssa * ssx)
+        w1 = (ssassx - sax) * (ssassx + sax) / (ssa * ssx)
+        w = 1.0 - w1
+
+        # Significance level of w
+        if n == 3:
+            pvalues = np.maximum(pi6 * (np.arcsin(np.sqrt(w)) - stqr), 0.0)
+
+        else:
+            y = np.log(w1)
+
+            if n <= 11:
+                gamma = poly(g, n)
+                m = poly(c3, n)
+                s = math.exp(poly(c4, n))
+                pvalues = np.where(
+                    y >= gamma,
+                    small,
+                    scipy.special.ndtr(-(-np.log(gamma - y) - m) / s)
+                )
+            else:
+                xx = math.log(n)
+                m = poly(c5, xx)
+                s = math.exp(poly(c6, xx))
+                pvalues = scipy.special.ndtr(-(y - m) / s)
+
+    return np.where(constant, 1.0, pvalues)
@@ -0,0 +1,318 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# vfc_ci plan : suggest the number of repetitions of every non-deterministic
+# backend of the tests config, from the metrics of previous runs. Each probe
+# needs the maximum of two numbers of samples :
+# - The bound of the sigdigits estimator that applies to it (General for
+#   non-normal distributions, CNH for normal ones, none for degenerate ones),
+#   which only depends on the configured probability, confidence and
+#   tolerance.
+# - The number of samples for which the variation of its significant digits
+#   between runs stays under the tolerance (with the configured confidence).
+#   This variation is measured on the sigma and mu of the probe in each run,
+#   and scaled to any number of samples from the nsamples of these runs.
+# Each backend gets the maximum over its probes.
+
+import sys
+import json
+import copy
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from .history import find_run_files, max_history_files
+from . import run_files
+from .test import read_config, get_executable_name
+from .test_data_processing import find_degenerate, needed_samples, \
+    confidence
+
+# Magic numbers
+min_repetitions = 3  # Minimal number of samples for the normality test
+min_variation_runs = 3  # Runs of a probe needed to measure its variation
+
+probe_index = ["test", "variable", "vfc_backend"]
+
+
+##########################################################################
+
+def read_history(directory, max_files):
+    '''
+    Read the metadata and data of the most recent run files of a directory,
+    as a list of (metadata, data) pairs
+    '''
+
+    runs = []
+
+    for path in find_run_files(directory)[:max_files]:
+        try:
+            metadata = run_files.read_table(path, "metadata").iloc[0]
+            data = run_files.read_table(
+                path,
+                "data",
+                columns=["mu", "sigma", "nsamples", "pvalue", "min", "max"]
+            )
+
+        except Exception:
+            print(
+                "Warning [vfc_ci]: Could not read %s, it will be ignored"
+                % path,
+                file=sys.stderr
+            )
+            continue
+
+        if not data.empty:
+            runs.append((metadata, data))
+
+    return runs
+
+
+def read_json_column(metadata, column):
+    '''Decode a JSON column of the metadata (empty if it is missing)'''
+
+    if column not in metadata or not isinstance(metadata[column], str):
+        return {}
+
+    return json.loads(metadata[column])
+
+
+def get_variation_samples(runs, tolerance):
+    '''
+    Number of samples needed by each probe so that the variation of its
+    significant digits between runs stays under the tolerance, as a Series
+    indexed by probe (probes found in less than min_variation_runs runs with
+    a non-zero sigma and mu are left out).
+    The significant digits estimated from n samples vary like k / (n - 1)
+    (k depends on the distribution of the probe). k is estimated from the
+    squared differences between successive runs, scaled by the nsamples of
+    these runs. Their median is used, so that a change of the probe between
+    two runs doesn't count as variation.
+    '''
+
+    history = []
+    for i, (metadata, data) in enumerate(runs):
+        if "sigma" not in data.columns or "nsamples" not in data.columns:
+            continue
+
+        sigma = data["sigma"].to_numpy(dtype=np.float64)
+        mu = data["mu"].to_numpy(dtype=np.float64)
+        nsamples = data["nsamples"].to_numpy(dtype=np.float64)
+
+        valid = (sigma > 0) & (mu != 0) & (nsamples >= 2) & \
+            np.isfinite(sigma) & np.isfinite(mu)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            history.append(pd.DataFrame({
+                "run": i,
+                "s2": -np.log2(sigma[valid] / np.abs(mu[valid])),
+                "inverse": 1 / (nsamples[valid] - 1)
+            }, index=data.index[valid]))
+
+    if len(history) == 0:
+        return pd.Series(dtype=np.int64)
+
+    history = pd.concat(history).reset_index().sort_values(
+        probe_index + ["run"])
+
+    # Differences between successive runs of the same probe, normalized by
+    # their expected variance (divided by k)
+    successive = history.groupby(probe_index, sort=False).cumcount() > 0
+    normalized = history["s2"].diff() ** 2 / \
+        (history["inverse"] + history["inverse"].shift())
+    normalized = normalized[successive].groupby(
+        [history.loc[successive, column] for column in probe_index]
+    )
+
+    # A normalized squared difference is k times a chi2 variable with one
+    # degree of freedom. k is bounded from below (the lower median of m
+    # differences is their j-th order statistic, whose quantile follows a
+    # beta distribution). Backends take the maximum over their probes, so
+    # the configured confidence is shared by all probes : the noise of the
+    # estimates of many probes doesn't increase the repetitions.
+    count = normalized.count()
+    count = count[count >= min_variation_runs - 1]
+    if len(count) == 0:
+        return pd.Series(dtype=np.int64)
+
+    j = np.floor((count - 1) / 2) + 1
+    quantile = scipy.stats.chi2.ppf(
+        scipy.stats.beta.ppf(
+            1 - (1 - confidence) / len(count), j, count - j + 1),
+        1
+    )
+    k = normalized.quantile(0.5, interpolation="lower")[count.index] / quantile
+
+    z = scipy.stats.norm.ppf(confidence)
+    return (1 + np.ceil(k * (z / tolerance) ** 2)).astype(np.int64)
+
+
+def get_needed_samples(data, variation, tolerance):
+    '''
+    Number of samples needed by each probe of a run, from its metrics and the
+    variation of its significant digits between runs (see
+    get_variation_samples)
+    '''
+
+    degenerate = find_degenerate(
+        data["min"].to_numpy(), data["max"].to_numpy())
+
+    needed = needed_samples(
+        data["mu"].to_numpy(),
+        data["pvalue"].to_numpy(),
+        degenerate,
+        tolerance
+    )
+
+    # Degenerate probes don't vary between runs
+    variation = variation.reindex(data.index).fillna(0).to_numpy()
+    needed = np.maximum(needed, np.where(degenerate, 0, variation))
+
+    return pd.Series(
+        np.maximum(needed, min_repetitions).astype(np.int64),
+        index=data.index)
+
+
+def find_executable(column, executable):
+    '''
+    Return the entry of an executable of the config in a JSON column of the
+    metadata (durations or tests), which is indexed by get_executable_name.
+    Runs written before parameters were part of this name are indexed by the
+    executable only.
+    '''
+
+    for name in [get_executable_name(executable), executable["executable"]]:
+        if name in column:
+            return column[name]
+
+    return {}
+
+
+def plan_backend(runs, needed, executable, backend):
+    '''
+    Return the number of repetitions needed by a backend of an executable of
+    the config (the maximum over all of its probes in all runs), and the
+    average duration of one of its repetitions in the most recent run that
+    knows it. Both are None if they can't be found in the runs.
+    '''
+
+    repetitions = None
+    duration = None
+
+    for (metadata, data), run_needed in zip(runs, needed):
+        selection = data.index.get_level_values("vfc_backend") == backend
+
+        # Only keep the tests of this executable if the run lists them
+        tests = find_executable(
+            read_json_column(metadata, "tests"), executable)
+        if backend in tests:
+            selection &= data.index.get_level_values("test").isin(
+                tests[backend])
+
+        if selection.any():
+            run_repetitions = int(run_needed[selection].max())
+            repetitions = run_repetitions if repetitions is None \
+                else max(repetitions, run_repetitions)
+
+        if duration is None:
+            duration = find_executable(
+                read_json_column(metadata, "durations"), executable
+            ).get(backend)
+
+    return repetitions, duration
+
+
+def run(directory, tolerance, output, max_files=max_history_files):
+    '''Entry point of vfc_ci plan'''
+
+    print("Info [vfc_ci]: Reading tests config file...")
+    config = read_config()
+
+    print("Info [vfc_ci]: Reading previous runs...")
+    runs = read_history(directory, max_files)
+
+    assert(len(runs) != 0), "Error [vfc_ci]: No run file containing " \
+        "non-deterministic results was found in %s" % directory
+
+    variation = get_variation_samples(runs, tolerance)
+    needed = [
+        get_needed_samples(data, variation, tolerance)
+        for metadata, data in runs
+    ]
+    suggested_config = copy.deepcopy(config)
+
+    current_time = 0
+    suggested_time = 0
+
+    print(
+        "Info [vfc_ci]: Suggested repetitions (from %s runs, with a "
+        "tolerance of %s bits) :" % (len(runs), tolerance)
+    )
+
+    for i, executable in enumerate(config["executables"]):
+        for j, backend in enumerate(executable["vfc_backends"]):
+
+            # Deterministic and adaptive backends are kept as they are
+            if "repetitions" not in backend or \
+                    isinstance(backend["repetitions"], dict):
+                continue
+
+            repetitions, duration = plan_backend(
+                runs, needed, executable, backend["name"])
+
+            if repetitions is None:
+                print(
+                    "- %s (%s) : %s (not found in previous runs)"
+                    % (get_executable_name(executable), backend["name"],
+                       backend["repetitions"])
+                )
+                continue
+
+            suggested_config["executables"][i]["vfc_backends"][j][
+                "repetitions"] = repetitions
+
+            print(
+                "- %s (%s) : %s -> %s"
+                % (get_executable_name(executable), backend["name"],
+                   backend["repetitions"], repetitions)
+            )
+
+            if duration is not None:
+                current_time += backend["repetitions"] * duration
+                suggested_time += repetitions * duration
+
+    if current_time > 0:
+        print(
+            "Info [vfc_ci]: Projected CPU time per run : %.1f s -> %.1f s "
+            "(%+.0f%%)"
+            % (current_time, suggested_time,
+               100 * (suggested_time - current_time) / current_time)
+        )
+
+    with open(output, "w") as file:
+        json.dump(suggested_config, file, indent=4)
+        file.write("\n")
+
+    print(
+        "Info [vfc_ci]: The suggested tests config has been written to %s."
+        % output
+    )
@@ -0,0 +1,235 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+# Reading and writing of run files. Run files contain 3 tables (metadata, data
+# and deterministic_data), and can be written in 2 formats :
+# - hdf5 : one HDF5 file (.vfcrun.h5), written with Pandas in fixed format
+# - parquet : one directory (.vfcrun.parquet) containing a Parquet file per
+#   table. Columns are typed (strings are dictionary-encoded instead of
+#   pickled), so they can be read separately, and row groups store the
+#   statistics of their columns.
+# Raw results files (.vfcraw) use the same formats. In HDF5 raw results files,
+# the samples of all probes are stored apart from the data table, as one
+# contiguous float64 dataset (/raw_values/samples, chunked and optionally
+# compressed), and the samples of the i-th probe of the data table are
+# samples[offsets[i]:offsets[i + 1]] (/raw_values/offsets). Samples of some
+# probes can be read without loading the others (see read_raw_values).
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# WARNING : Using the hdf5 format requires to install "tables", and the
+# parquet format requires to install "pyarrow"
+formats = {"hdf5": ".h5", "parquet": ".parquet"}
+tables = ["metadata", "data", "deterministic_data"]
+
+# Magic numbers
+row_group_size = 65536  # Number of rows of Parquet row groups
+raw_chunk_size = 65536  # Number of samples of HDF5 raw values chunks
+raw_compression_level = 5  # zlib level of compressed HDF5 raw values
+
+
+##########################################################################
+
+def get_path(filename, kind="vfcrun", file_format="hdf5"):
+    '''Path of a run file (kind is vfcrun or vfcraw)'''
+
+    return "%s.%s%s" % (filename, kind, formats[file_format])
+
+
+def is_run_file(name, kind="vfcrun"):
+    return any(
+        name.endswith("." + kind + extension)
+        for extension in formats.values()
+    )
+
+
+def write_table(path, key, table):
+    '''Write one table of a run file (its format depends on the path)'''
+
+    if path.endswith(formats["hdf5"]):
+        table.to_hdf(path, key=key)
+        return
+
+    os.makedirs(path, exist_ok=True)
+    table.to_parquet(
+        os.path.join(path, key + ".parquet"),
+        engine="pyarrow",
+        row_group_size=row_group_size,
+        use_dictionary=True,
+        write_statistics=True
+    )
+
+
+def read_table(path, key, columns=None, filters=None):
+    '''
+    Read one table of a run file. In Parquet run files, only the requested
+    columns are read (the index is always read), and filters (see
+    pyarrow.parquet.read_table) can skip row groups using their statistics.
+    '''
+
+    if path.endswith(formats["hdf5"]):
+        table = pd.read_hdf(path, key)
+        if columns is not None:
+            table = table[[
+                column for column in columns if column in table.columns
+            ]]
+        return table
+
+    import pyarrow.parquet
+
+    # Columns that aren't in the file (for instance in empty tables) are
+    # ignored, as in HDF5 run files
+    path = os.path.join(path, key + ".parquet")
+    if columns is not None:
+        names = pyarrow.parquet.read_schema(path).names
+        columns = [column for column in columns if column in names]
+
+    return pd.read_parquet(
+        path,
+        engine="pyarrow",
+        columns=columns,
+        filters=filters
+    )
+
+
+def get_sample_blocks(data, offsets, groups=None):
+    '''
+    Yield the samples of the probes of a data table as flat arrays, by blocks
+    of raw_chunk_size probes. Samples are either in the values column, or
+    grouped by number of samples (groups, see group_by_nsamples).
+    '''
+
+    for start in range(0, len(data), raw_chunk_size):
+        stop = min(start + raw_chunk_size, len(data))
+
+        if groups is None:
+            block = data["values"].iloc[start:stop]
+            if offsets[stop] > offsets[start]:
+                yield np.concatenate(block.to_list())
+            continue
+
+        block = np.empty(offsets[stop] - offsets[start], dtype=np.float64)
+        for n, (rows, distributions, inverse) in groups.items():
+            first, last = np.searchsorted(rows, [start, stop])
+            positions = offsets[rows[first:last]] - offsets[start]
+            block[positions[:, None] + np.arange(n)] = \
+                distributions[inverse[first:last]]
+        yield block
+
+
+def write_raw_data(path, data, compress=False, groups=None):
+    '''
+    Write the data table of a raw results file, with the samples of its
+    probes (values column, or groups, see get_sample_blocks). In HDF5 files,
+    samples are written as a ragged array, which can be compressed.
+    '''
+
+    is_hdf5 = path.endswith(formats["hdf5"])
+    if groups is None and (not is_hdf5 or "values" not in data.columns):
+        write_table(path, "data", data)
+        return
+
+    if groups is not None:
+        counts = np.zeros(len(data), dtype=np.int64)
+        for n, (rows, distributions, inverse) in groups.items():
+            counts[rows] = n
+    else:
+        counts = np.fromiter(
+            (len(values) for values in data["values"]),
+            dtype=np.int64,
+            count=len(data)
+        )
+
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Parquet files store the samples of each probe as a list
+    if not is_hdf5:
+        samples = np.concatenate(
+            [np.empty(0)] + list(get_sample_blocks(data, offsets, groups)))
+        write_table(
+            path,
+            "data",
+            data.assign(values=np.split(samples, offsets[1:-1]))
+        )
+        return
+
+    import tables
+
+    write_table(path, "data", data.drop(columns="values", errors="ignore"))
+
+    filters = None
+    if compress:
+        filters = tables.Filters(
+            complevel=raw_compression_level, complib="zlib", shuffle=True)
+
+    with tables.open_file(path, "a") as file:
+        if "/raw_values" in file:
+            file.remove_node("/raw_values", recursive=True)
+
+        group = file.create_group("/", "raw_values")
+        samples = file.create_earray(
+            group,
+            "samples",
+            tables.Float64Atom(),
+            shape=(0,),
+            filters=filters,
+            chunkshape=(raw_chunk_size,),
+            expectedrows=int(offsets[-1])
+        )
+
+        # Probes are appended by blocks, so no copy of all samples is needed
+        for block in get_sample_blocks(data, offsets, groups):
+            samples.append(block)
+
+        file.create_array(group, "offsets", offsets)
+
+
+def read_raw_values(path, rows=None):
+    '''
+    Read the samples of the probes of a raw results file, as a list of
+    arrays. rows are the positions of the probes in the data table (all
+    probes by default). In HDF5 files, only the samples of these probes are
+    read.
+    '''
+
+    if not path.endswith(formats["hdf5"]):
+        values = read_table(path, "data", columns=["values"])["values"]
+        if rows is not None:
+            values = values.iloc[rows]
+        return [np.asarray(samples) for samples in values]
+
+    import tables
+
+    with tables.open_file(path, "r") as file:
+        offsets = file.root.raw_values.offsets[:]
+        samples = file.root.raw_values.samples
+
+        if rows is None:
+            flat = samples[:]
+            return np.split(flat, offsets[1:-1])
+
+        return [samples[offsets[row]:offsets[row + 1]] for row in rows]
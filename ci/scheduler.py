@@ -0,0 +1,276 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+
+
+# Asynchronous scheduler used by vfc_ci test to run all test executions
+# (executables x backends x repetitions) as one flat set of jobs sharing a
+# global concurrency limit. Each job is pinned to its own set of cores (one
+# per thread), so concurrent jobs never share cores.
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+
+##########################################################################
+
+def get_cores():
+    '''Return the cores this process is allowed to run on'''
+
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def available_cores():
+    '''Return the number of cores this process is allowed to run on'''
+
+    return len(get_cores())
+
+
+class CoreAllocator:
+    '''
+    Keep track of the cores used by running jobs. Jobs get the free cores
+    with the lowest numbers, so the cores of a job are usually neighbours
+    (and share their caches). Jobs with more threads than cores get all
+    cores.
+    '''
+
+    def __init__(self):
+        self.cores = get_cores()
+        self.free = set(self.cores)
+
+    def needed(self, threads):
+        return min(threads, len(self.cores))
+
+    def allocate(self, threads):
+        '''Return the cores of a job, or None if there aren't enough'''
+
+        threads = self.needed(threads)
+        if len(self.free) < threads:
+            return None
+
+        cores = sorted(self.free)[:threads]
+        self.free.difference_update(cores)
+        return cores
+
+    def release(self, cores):
+        self.free.update(cores)
+
+
+##########################################################################
+
+# Job description
+
+class Job:
+    '''
+    A single execution of a test command. Its probes will be written to a
+    temporary file (output_path) that is created when the job is started.
+    '''
+
+    def __init__(
+            self,
+            key,
+            group,
+            command,
+            backend,
+            timeout,
+            description="execution",
+            threads=1):
+
+        # key identifies the job for the caller, group is used to enforce
+        # per-group (usually per-executable) concurrency limits
+        self.key = key
+        self.group = group
+
+        self.command = command
+        self.backend = backend
+        self.timeout = timeout
+        self.description = description
+
+        # Number of threads of the execution, and cores it is pinned to (set
+        # when the job is started)
+        self.threads = threads
+        self.cores = None
+
+        self.output_path = None
+
+        # Wall time of the execution (in seconds), known once it has finished
+        self.duration = None
+
+    def environment(self):
+        '''
+        Return the environment of the job's process. The backend and probes
+        output path are passed to the child process only (and not through the
+        global environment), so several jobs can run at the same time.
+        '''
+
+        env = dict(os.environ)
+        env["VFC_BACKENDS"] = self.backend
+        env["VFC_PROBES_OUTPUT"] = self.output_path
+
+        # OpenMP codes use as many threads as they have cores
+        if self.cores is not None:
+            env["OMP_NUM_THREADS"] = str(len(self.cores))
+
+        return env
+
+    def set_affinity(self):
+        '''Pin the calling process to the job's cores (if supported)'''
+
+        if self.cores is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cores)
+
+    def cleanup(self):
+        '''Remove the job's output file (once its results have been read)'''
+
+        if self.output_path is not None and os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+##########################################################################
+
+# Jobs execution
+
+def create_output_path(job):
+    fd, job.output_path = tempfile.mkstemp(prefix="vfc_probes_", suffix=".csv")
+    os.close(fd)
+    # The file is created again by vfc_dump_probes, so a missing file means
+    # that no probes have been dumped
+    os.remove(job.output_path)
+
+
+async def execute_job(job):
+    '''Run a job as an asynchronous subprocess'''
+
+    create_output_path(job)
+
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *job.command.split(),
+        env=job.environment(),
+        preexec_fn=job.set_affinity
+    )
+
+    try:
+        await asyncio.wait_for(process.wait(), job.timeout)
+    except asyncio.TimeoutError:
+        print(
+            "Warning [vfc_ci]: %s was timed out" % job.description,
+            file=sys.stderr)
+        process.kill()
+        await process.wait()
+
+    job.duration = time.monotonic() - start
+
+
+##########################################################################
+
+# Scheduler
+
+class Scheduler:
+    '''
+    Run jobs as asynchronous subprocesses. Pending jobs are started in
+    submission order as soon as the global limit, the limit of their group
+    and the free cores allow it. Each job is passed to a callback as soon as
+    it finishes, and this callback can submit new jobs.
+    '''
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.limits = {}
+        self.cores = CoreAllocator()
+
+        self.pending = []
+        self.running = {}
+        self.running_by_group = {}
+
+    def set_limit(self, group, limit):
+        '''Set the maximum number of concurrent jobs of a group'''
+
+        self.limits[group] = limit
+
+    def submit(self, job):
+        self.pending.append(job)
+
+    def can_start(self, job):
+        limit = self.limits.get(job.group)
+        return limit is None or self.running_by_group.get(job.group, 0) < limit
+
+    def start_jobs(self):
+        '''
+        Start as many pending jobs as the limits allow. Once a job can't get
+        enough free cores, no later job is started : the cores released by
+        running jobs are kept for it, so jobs with many threads aren't starved
+        by jobs with fewer threads.
+        '''
+
+        remaining = []
+        waiting_cores = False
+
+        for job in self.pending:
+            cores = None
+            if not waiting_cores and len(self.running) < self.max_jobs and \
+                    self.can_start(job):
+                cores = self.cores.allocate(job.threads)
+                waiting_cores = cores is None
+
+            if cores is not None:
+                job.cores = cores
+                task = asyncio.ensure_future(execute_job(job))
+                self.running[task] = job
+                self.running_by_group[job.group] = \
+                    self.running_by_group.get(job.group, 0) + 1
+            else:
+                remaining.append(job)
+
+        self.pending = remaining
+
+    async def run_jobs(self, callback):
+        self.start_jobs()
+
+        while len(self.running) > 0:
+            done, _ = await asyncio.wait(
+                list(self.running.keys()),
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in done:
+                job = self.running.pop(task)
+                self.running_by_group[job.group] -= 1
+                self.cores.release(job.cores)
+
+                # Raise execution errors (if any) before collecting results
+                task.result()
+                callback(job)
+
+            self.start_jobs()
+
+    def run(self, callback):
+        '''Run all submitted jobs (and those submitted by the callback)'''
+
+        asyncio.run(self.run_jobs(callback))
@@ -38,7 +38,8 @@ def run(
         allow_origin,
         logo_url,
         max_files,
-        ignore_recent):
+        ignore_recent,
+        database=None):
     '''Entry point of vfc_ci serve'''
 
     # Prepare arguments
@@ -47,6 +48,7 @@ def run(
     logo = "logo %s" % logo_url if logo_url else ""
     max_files = "max_files %s" % max_files if max_files else ""
     ignore_recent = "ignore_recent %s" % ignore_recent if ignore_recent else ""
+    database = "database %s" % os.path.abspath(database) if database else ""
 
     dirname = os.path.dirname(__file__)
 
@@ -57,8 +59,8 @@ def run(
     # generating the Jinja template, etc... => This is an option for a future
     # commit.
 
-    command = "bokeh serve %s/vfc_ci_report %s --allow-websocket-origin=%s:%s --port %s --args %s %s %s %s" \
-        % (dirname, show, allow_origin, port, port, directory, logo, max_files, ignore_recent)
+    command = "bokeh serve %s/vfc_ci_report %s --allow-websocket-origin=%s:%s --port %s --args %s %s %s %s %s" \
+        % (dirname, show, allow_origin, port, port, directory, logo, max_files, ignore_recent, database)
     command = os.path.normpath(command)
 
     os.system(command)
@@ -25,14 +25,22 @@
 # This script reads the vfc_tests_config.json file and executes tests accordingly
 # It will also generate a ... .vfcrunh5 file with the results of the run
 
-from .test_data_processing import data_processing, validate_deterministic_probe
+from .test_data_processing import data_processing, \
+    validate_deterministic_checks, group_by_nsamples, required_samples
+from .scheduler import Job, Scheduler, available_cores
+from .distributed import DistributedScheduler
+from .history import read_durations
+from .accumulators import ProbesAccumulator
+from .checkpoint import Checkpoint
+from . import cache
+from . import run_files
+from . import database
+from . import manifest
 import pandas as pd
 import numpy as np
 import os
-import subprocess
 import sys
 import json
-import tempfile
 import calendar
 import time
 
@@ -55,7 +63,18 @@ def read_probes_csv(filepath, warnings, execution_data):
 
     try:
 
-        results = pd.read_csv(filepath)
+        # Values are written with %a by vfc_dump_probes, so they are decoded
+        # with float.fromhex while the file is parsed. This is still one
+        # Python call per value, but it costs less than creating the strings
+        # of the columns would, so the tokenizer of read_csv dominates.
+        results = pd.read_csv(
+            filepath,
+            dtype={"test": str, "variable": str, "check_mode": str},
+            converters={
+                "value": float.fromhex,
+                "accuracy_threshold": float.fromhex
+            }
+        )
 
     except FileNotFoundError:
         print(
@@ -111,12 +130,8 @@ def read_probes_csv(filepath, warnings, execution_data):
         warnings.append(execution_data)
 
     # Once the CSV has been opened and validated, return its content
-    results["value"] = results["value"].apply(lambda x: float.fromhex(x))
     results.rename(columns={"value": "values"}, inplace=True)
 
-    results["accuracy_threshold"] = results["accuracy_threshold"].apply(
-        lambda x: float.fromhex(x))
-
     results["vfc_backend"] = execution_data["backend"]
 
     # Extract accuracy thresholds data
@@ -190,228 +205,850 @@ def generate_metadata(is_git_commit):
     return metadata
 
 
-def run_non_deterministic(
-        command,
-        repetitions,
-        executable,
-        backend,
-        data,
-        checks_data,
-        warnings):
-    '''
-    Loop execution for non-deterministic backends. This will also export checks
-    so they can be merged later with the data (after the likely duplicates have
-    been removed).
-    '''
+def get_execution_data(config, key):
+    '''Return the description of a job (used to report warnings)'''
 
-    # Run test repetitions and save results
-    for i in range(repetitions):
-        temp = tempfile.NamedTemporaryFile()
-        os.putenv("VFC_PROBES_OUTPUT", temp.name)
+    kind, executable_index, backend_index, repetition = key
+    executable = config["executables"][executable_index]
 
-        p = subprocess.Popen(command.split())
-        try:
-            p.wait(timeout)
-        except subprocess.TimeoutExpired:
-            print(
-                "Warning [vfc_ci]: execution was timed out",
-                file=sys.stderr)
-            p.kill()
-
-        execution_data = {
-            "executable": executable,
-            "backend": backend,
-            "repetition": i + 1
-        }
-
-        run_data, run_check_data = read_probes_csv(
-            temp.name,
-            warnings,
-            execution_data
-        )
-
-        data.append(run_data)
-        checks_data.append(run_check_data)
+    # Reference runs are shared by all deterministic backends
+    if kind == "reference":
+        backend = "libinterflop_ieee.so (reference run)"
+    else:
+        backend = executable["vfc_backends"][backend_index]["name"]
 
-        temp.close()
+    return {
+        "executable": executable["executable"],
+        "backend": backend,
+        "repetition": repetition
+    }
 
 
-def run_deterministic(
-        command,
-        executable,
-        backend,
-        deterministic_data,
-        warnings):
+def run_non_deterministic(job, config, accumulator, slots, tests, warnings):
     '''
-    Single execution for deterministic test. If some probes are associated to an
-    check, an IEEE run will also be executed as a reference. The check will be
-    checked directly, since it doesn't really require any data processing.
+    Collect one repetition of a non-deterministic backend. Its probes are
+    folded into the accumulator right away (in the slot of the repetition),
+    with their checks. The names of its tests are added to the tests of the
+    executable/backend (executables are named by get_executable_name).
+    Returns the rows of the probes in the accumulator.
     '''
 
-    temp = tempfile.NamedTemporaryFile()
-    os.putenv("VFC_PROBES_OUTPUT", temp.name)
+    execution_data = get_execution_data(config, job.key)
+    run_data, run_check_data = read_probes_csv(
+        job.output_path,
+        warnings,
+        execution_data
+    )
+
+    tests.setdefault(
+        get_executable_name(config["executables"][job.key[1]]), {}
+    ).setdefault(
+        execution_data["backend"], set()).update(run_data["test"].unique())
+
+    return accumulator.add(
+        slots[job.key],
+        job.backend,
+        run_data["test"].to_numpy(),
+        run_data["variable"].to_numpy(),
+        run_data["values"].to_numpy(),
+        run_check_data["accuracy_threshold"].to_numpy(),
+        run_check_data["check_mode"].to_numpy()
+    )
 
-    p = subprocess.Popen(command.split())
-    try:
-        p.wait(timeout)
-    except subprocess.TimeoutExpired:
-        print(
-            "Warning [vfc_ci]: execution was timed out",
-            file=sys.stderr)
-        p.kill()
 
-    execution_data = {
-        "executable": executable,
-        "backend": backend,
-        "repetition": 1
-    }
+def run_deterministic(job, config, results, warnings):
+    '''
+    Collect the single execution of a deterministic test. If some of its
+    probes are associated to a check, they will be validated against the IEEE
+    reference run of the executable once all jobs are done (see
+    compare_to_reference).
+    '''
 
     run_data, run_checks_data = read_probes_csv(
-        temp.name,
+        job.output_path,
         warnings,
-        execution_data
+        get_execution_data(config, job.key)
     )
 
     run_data.rename(columns={"values": "value"}, inplace=True)
     run_data["accuracy_threshold"] = run_checks_data["accuracy_threshold"]
     run_data["check_mode"] = run_checks_data["check_mode"]
 
-    # If checks are detected, do a reference run (with IEEE backend)
-    if run_data["accuracy_threshold"].sum() != 0:
+    results[job.key] = run_data
 
-        temp.close()
 
-        os.putenv("VFC_BACKENDS", "libinterflop_ieee.so")
-        temp = tempfile.NamedTemporaryFile()
-        os.putenv("VFC_PROBES_OUTPUT", temp.name)
+def run_reference(job, config, references, warnings):
+    '''
+    Collect the IEEE reference run of an executable (its checks are validated
+    later on)
+    '''
 
-        p = subprocess.Popen(command.split())
-        try:
-            p.wait(timeout)
-        except subprocess.TimeoutExpired:
-            print(
-                "Warning [vfc_ci]: reference execution was timed out",
-                file=sys.stderr)
-            p.kill()
+    references[job.key[1]] = read_probes_csv(
+        job.output_path,
+        warnings,
+        get_execution_data(config, job.key)
+    )[0]
 
-        execution_data = {
-            "executable": executable,
-            "backend": "libinterflop_ieee.so (reference run)",
-            "repetition": 1
-        }
 
-        reference_run_data = read_probes_csv(
-            temp.name,
-            warnings,
-            execution_data
-        )[0]
+def get_reference_key(executable_index):
+    '''Key of the IEEE reference run of an executable'''
 
-        run_data["reference_value"] = reference_run_data["values"]
-        run_data["check"] = run_data.apply(
-            lambda x: validate_deterministic_probe(x), axis=1
-        )
+    return ("reference", executable_index, -1, 1)
 
-    else:
+
+def compare_to_reference(run_data, reference_data):
+    '''
+    Validate the checks of the probes of a deterministic run (if some of them
+    are associated to a check), by joining them to their IEEE reference
+    values on test and variable
+    '''
+
+    if run_data["accuracy_threshold"].sum() == 0:
         run_data["reference_value"] = 0
         run_data["check"] = True
+        return run_data
+
+    reference_values = reference_data[["test", "variable", "values"]] \
+        .drop_duplicates(["test", "variable"]) \
+        .rename(columns={"values": "reference_value"})
+    run_data = run_data.merge(
+        reference_values, on=["test", "variable"], how="left")
+
+    run_data["check"] = validate_deterministic_checks(
+        run_data["check_mode"].to_numpy(),
+        run_data["accuracy_threshold"].to_numpy(),
+        run_data["value"].to_numpy(dtype=np.float64),
+        run_data["reference_value"].to_numpy(dtype=np.float64)
+    )
+
+    return run_data
+
+
+def get_repetitions(backend):
+    '''
+    Return the minimum and maximum numbers of repetitions of a
+    non-deterministic backend, and the tolerance (in bits) on its significant
+    digits. The repetitions are either a fixed number (with no tolerance), or
+    adaptive : {"min": ..., "max": ..., "tolerance": ...}.
+    '''
+
+    repetitions = backend["repetitions"]
+    if not isinstance(repetitions, dict):
+        return repetitions, repetitions, None
+
+    assert(set(repetitions.keys()) == {"min", "max", "tolerance"}), \
+        "Error [vfc_ci]: Adaptive repetitions must be described by their " \
+        "\"min\", \"max\" and \"tolerance\""
+    assert(3 <= repetitions["min"] <= repetitions["max"]), \
+        "Error [vfc_ci]: Adaptive repetitions must have 3 <= min <= max"
+    assert(repetitions["tolerance"] > 0), \
+        "Error [vfc_ci]: The tolerance of adaptive repetitions must be " \
+        "strictly positive"
+
+    return repetitions["min"], repetitions["max"], repetitions["tolerance"]
+
+
+def get_threads(executable):
+    '''
+    Return the number of threads (and so of cores) used by each execution of
+    an executable (1 unless specified with "threads")
+    '''
+
+    threads = executable.get("threads", 1)
+    assert(isinstance(threads, int) and threads > 0), \
+        "Error [vfc_ci]: The number of threads of %s must be a strictly " \
+        "positive integer" % executable["executable"]
+
+    return threads
+
+
+def get_next_repetitions(accumulator, rows, launched, maximum, tolerance):
+    '''
+    Return the number of repetitions an adaptive backend should reach, given
+    the samples of its probes (rows of the accumulator) after launched
+    repetitions. This is launched if all of its probes have converged (or if
+    the maximum has been reached). Otherwise, the number of repetitions grows
+    at most geometrically, since the normality of the probes (and so the
+    number of samples they need) can change with more samples.
+    '''
+
+    if launched >= maximum or len(rows) == 0:
+        return launched
+
+    missing = 0
+    groups = group_by_nsamples(accumulator.get_samples(rows))
+
+    for n, (group_rows, distributions, inverse) in groups.items():
+        # Too few samples to even test normality (some repetitions failed)
+        if n < 3:
+            missing = max(missing, 3 - n)
+            continue
+
+        required = required_samples(distributions, tolerance)
+        missing = max(missing, int((required - n).max()))
+
+    if missing <= 0:
+        return launched
+
+    return min(maximum, 2 * launched, launched + missing)
+
+
+def get_executable_name(executable):
+    '''
+    Name under which the durations of an executable of the config are
+    recorded : the executable and its parameters, since the same binary can
+    be run with different parameters
+    '''
+
+    if executable.get("parameters", "") == "":
+        return executable["executable"]
+    return "%s %s" % (executable["executable"], executable["parameters"])
+
+
+def get_expected_duration(config, durations_history, key):
+    '''
+    Return the duration of a job in the previous runs, or None if it is
+    unknown
+    '''
+
+    execution_data = get_execution_data(config, key)
+    return durations_history.get(
+        get_executable_name(config["executables"][key[1]]), {}
+    ).get(execution_data["backend"])
+
+
+def sort_jobs(config, jobs, durations_history):
+    '''
+    Sort jobs from the longest to the shortest expected duration (according to
+    the durations of previous runs). This reduces the total run time, since
+    long jobs won't be started last. Jobs whose duration is unknown are
+    started first, in the config order (they might as well be the longest).
+    '''
+
+    def expected_duration(job):
+        duration = get_expected_duration(config, durations_history, job.key)
+
+        if duration is None:
+            return (0, 0)
+        return (1, -duration)
+
+    return sorted(jobs, key=expected_duration)
+
+
+def select_shard(config, jobs, durations_history, shard):
+    '''
+    Return the jobs of a shard (index, count) of the run, and a digest of the
+    partition of all jobs into shards. Jobs are assigned to shards from the
+    longest to the shortest (according to the durations of previous runs), to
+    the shard with the lowest total duration so far. The partition only
+    depends on the config and the durations, so shards run with the same
+    history get complementary jobs. All repetitions of an adaptive backend are
+    assigned to the same shard, since new batches depend on all samples.
+    '''
+
+    index, count = shard
+
+    units = {}
+    for job in jobs:
+        unit = job.key
+        if job.key[0] == "non_deterministic":
+            backend = config["executables"][job.key[1]]["vfc_backends"][
+                job.key[2]]
+            if get_repetitions(backend)[2] is not None:
+                unit = job.key[1:3]
+        units.setdefault(unit, []).append(job)
+
+    # Unknown durations are replaced by the average known duration
+    durations = {
+        job.key: get_expected_duration(config, durations_history, job.key)
+        for job in jobs
+    }
+    known = [
+        duration for duration in durations.values() if duration is not None
+    ]
+    default = sum(known) / len(known) if len(known) > 0 else 1
+
+    def cost(unit_jobs):
+        return sum(
+            default if durations[job.key] is None else durations[job.key]
+            for job in unit_jobs
+        )
+
+    # Ties are broken by the config order, so the partition is deterministic
+    ordered = sorted(
+        units.values(),
+        key=lambda unit_jobs: (-cost(unit_jobs), unit_jobs[0].key[1:])
+    )
+
+    loads = [0] * count
+    partition = [[] for i in range(count)]
+    for unit_jobs in ordered:
+        target = loads.index(min(loads))
+        loads[target] += cost(unit_jobs)
+        partition[target].extend(unit_jobs)
+
+    digest = cache.hash_key([
+        sorted(list(job.key) for job in shard_jobs)
+        for shard_jobs in partition
+    ])
+
+    return partition[index - 1], digest
+
+
+def get_rank_offsets(config):
+    '''
+    Return the rank of the first repetition of each non-deterministic backend
+    ({(executable index, backend index): rank}). Samples are sorted by rank,
+    which follows the config order, and doesn't depend on the repetitions
+    that are actually run (so samples of different shards can be merged).
+    '''
+
+    offsets = {}
+    offset = 0
+
+    for i, executable in enumerate(config["executables"]):
+        for j, backend in enumerate(executable["vfc_backends"]):
+            if "repetitions" in backend:
+                offsets[(i, j)] = offset
+                offset += get_repetitions(backend)[1]
+
+    return offsets
+
+
+def get_durations(config, jobs):
+    '''
+    Return the average duration of one execution for every (executable,
+    backend) as a dict of dicts ({executable: {backend: seconds}}), where
+    executables are named by get_executable_name. Jobs abandoned by the
+    distributed scheduler have no duration.
+    '''
+
+    measures = {}
+    for job in jobs:
+        if job.duration is None:
+            continue
+        execution_data = get_execution_data(config, job.key)
+        measures.setdefault(
+            (get_executable_name(config["executables"][job.key[1]]),
+             execution_data["backend"]), []
+        ).append(job.duration)
+
+    durations = {}
+    for (executable, backend), values in measures.items():
+        durations.setdefault(executable, {})[backend] = \
+            sum(values) / len(values)
+
+    return durations
+
+
+def get_cache_keys(config):
+    '''
+    Return the result cache key of every (executable, backend) as a dict
+    indexed by their positions in the config. The results of a backend only
+    depend on the binary of the executable, the libraries it is linked to,
+    its optional "inputs" files, its parameters, its number of threads (which
+    can change roundings), the backend, the number of repetitions and the
+    version of Verificarlo. The reference run of an executable has its own
+    key (with -1 as backend position). Executables that can't be found have
+    no key.
+    '''
+
+    verificarlo_version = cache.command_version("verificarlo --version")
+    keys = {}
+
+    for i, executable in enumerate(config["executables"]):
+        path = executable["executable"]
+        if not os.path.isfile(path):
+            continue
+
+        fingerprint = {
+            "binary": cache.hash_file(path),
+            "libraries": [
+                [library, cache.hash_file(library)]
+                for library in cache.linked_libraries(path)
+            ],
+            "inputs": cache.hash_inputs(executable.get("inputs", []))
+        }
+
+        for j, backend in enumerate(executable["vfc_backends"]):
+            keys[(i, j)] = {
+                "executable": fingerprint,
+                "parameters": executable.get("parameters", ""),
+                "threads": get_threads(executable),
+                "backend": backend["name"],
+                "repetitions": backend.get("repetitions"),
+                "verificarlo": verificarlo_version
+            }
+
+        # The IEEE reference run is the same for all deterministic backends
+        keys[get_reference_key(i)[1:3]] = {
+            "executable": fingerprint,
+            "parameters": executable.get("parameters", ""),
+            "threads": get_threads(executable),
+            "reference": True,
+            "verificarlo": verificarlo_version
+        }
+
+    return keys
+
+
+def has_all_repetitions(config, position, repetitions):
+    '''
+    Return True if the repetitions (numbers) of the jobs of a backend (given
+    by its position in the config) form its complete set of samples. This
+    isn't the case when some of its repetitions belong to other shards.
+    '''
+
+    i, j = position
+    if j < 0:
+        return True
+
+    backend = config["executables"][i]["vfc_backends"][j]
+    if "repetitions" not in backend:
+        return True
+
+    minimum, maximum, tolerance = get_repetitions(backend)
+    repetitions = sorted(repetitions)
+    if repetitions != list(range(1, len(repetitions) + 1)):
+        return False
+
+    if tolerance is None:
+        return len(repetitions) == maximum
+    return len(repetitions) >= minimum
+
+
+def load_cached_results(config, cache_keys):
+    '''
+    Look for the results of every (executable, backend) in the result cache.
+    Returns a dict associating the key of each cached job to the path of its
+    probes and to its duration.
+    '''
+
+    cached = {}
+
+    for (i, j), key in cache_keys.items():
+        entry = cache.load_entry("results", key)
+        if entry is None:
+            continue
+
+        # Partial sets of repetitions aren't reused
+        if not has_all_repetitions(
+                config,
+                (i, j),
+                [repetition for kind, repetition, duration
+                 in entry["data"]["jobs"]]):
+            continue
+
+        for (kind, repetition, duration), (path, digest, mode) in zip(
+                entry["data"]["jobs"], entry["files"]):
+            cached[(kind, i, j, repetition)] = (
+                cache.object_path(digest), duration)
 
-    deterministic_data.append(run_data)
+    return cached
 
-    temp.close()
+
+def save_cached_results(
+        config, cache_keys, cached, checkpoint, executed_jobs):
+    '''
+    Store the results of every (executable, backend) that has been executed
+    in the result cache. The probes of its jobs are taken from the checkpoint,
+    so backends with some failed jobs (which haven't been checkpointed) are
+    not cached. Backends whose repetitions are split between shards are not
+    cached either, since their results are incomplete.
+    '''
+
+    for (i, j), key in cache_keys.items():
+        group = [
+            job for job in executed_jobs.values() if job.key[1:3] == (i, j)
+        ]
+
+        if len(group) == 0 or any(job.key in cached for job in group):
+            continue
+        if not all(checkpoint.saved(job.key) for job in group):
+            continue
+        if not has_all_repetitions(
+                config, (i, j), [job.key[3] for job in group]):
+            continue
+
+        cache.save_entry(
+            "results",
+            key,
+            [checkpoint.path(job.key) + ".csv" for job in group],
+            {"jobs": [[job.key[0], job.key[3], job.duration] for job in group]}
+        )
 
 
-def run_tests(config):
+def build_tests(config, use_cache=True):
     '''
-    Execute tests and collect results in a Pandas dataframe
+    Run the build command. If a build cache is described in the config
+    ("build_cache", with the glob patterns of its "inputs"), the build is
+    skipped when its inputs, the compiler and Verificarlo haven't changed since
+    a previous build of the same project directory, and its outputs (by
+    default the executables) are restored from the cache instead. The cache
+    isn't used if some patterns of the inputs don't match any file.
     '''
 
-    # Run the build command
+    build_cache = config.get("build_cache")
+
+    # Without inputs, the key of the build wouldn't depend on the sources
+    if build_cache is not None:
+        inputs = build_cache.get("inputs", [])
+        unmatched = cache.unmatched_inputs(inputs)
+
+        if len(inputs) == 0 or len(unmatched) > 0:
+            print(
+                "Warning [vfc_ci]: The build cache is disabled, since %s"
+                % ("it has no inputs" if len(inputs) == 0 else
+                   "these inputs don't match any file : %s"
+                   % ", ".join(unmatched)),
+                file=sys.stderr
+            )
+            build_cache = None
+
+    if build_cache is None:
+        print("Info [vfc_ci]: Building tests...")
+        os.system(config["make_command"])
+        return
+    outputs = build_cache.get(
+        "outputs",
+        [executable["executable"] for executable in config["executables"]]
+    )
+
+    # The cache is shared by all projects, and the inputs and outputs are
+    # relative to the project directory
+    key = {
+        "directory": os.getcwd(),
+        "make_command": config["make_command"],
+        "inputs": cache.hash_inputs(build_cache["inputs"]),
+        "outputs": outputs,
+        "compiler": cache.command_version(
+            build_cache.get("compiler", "verificarlo-c") + " --version"),
+        "verificarlo": cache.command_version("verificarlo --version")
+    }
+
+    entry = cache.load_entry("builds", key) if use_cache else None
+    if entry is not None:
+        print("Info [vfc_ci]: Restoring tests from the build cache...")
+        for path, digest, mode in entry["files"]:
+            cache.restore_file(digest, path, mode)
+        return
+
     print("Info [vfc_ci]: Building tests...")
-    os.system(config["make_command"])
+    status = os.system(config["make_command"])
 
-    # These are arrays of Pandas dataframes for now
-    data = []
-    deterministic_data = []
+    missing = [path for path in outputs if not os.path.isfile(path)]
+    if status != 0 or len(missing) > 0:
+        print(
+            "Warning [vfc_ci]: The build command failed or didn't create all "
+            "of its outputs, so it won't be cached",
+            file=sys.stderr
+        )
+        return
 
-    # Only for non-deterministic data. Stored separately for now since it is
-    # easier to add this to data after the groupby.
-    checks_data = []
+    cache.save_entry("builds", key, outputs)
 
-    # This will contain all executables/repetition numbers from which we could
-    # not get any data
-    warnings = []
 
-    # Executables iteration
-    for executable in config["executables"]:
-        print("Info [vfc_ci]: Running executable :",
-              executable["executable"], "...")
+def run_tests(
+        config,
+        jobs,
+        durations_history,
+        checkpoint,
+        use_cache=True,
+        queue_directory=None,
+        shard=None):
+    '''
+    Execute tests and collect results in a Pandas dataframe. Jobs that are
+    in the result cache or have been saved in the checkpoint are collected
+    from there instead of being executed again. If a queue directory is
+    specified, jobs are run by the workers of this queue instead. If a shard
+    (index, count) is specified, only the jobs of this shard are run.
+    Outside of shards, the samples of the probes are returned grouped by
+    number of samples (see ProbesAccumulator.group_samples) instead of in the
+    values column of the dataframe.
+    '''
+
+    # Run the build command (or restore its results)
+    build_tests(config, use_cache)
+
+    cache_keys = get_cache_keys(config)
+    cached = load_cached_results(config, cache_keys) if use_cache else {}
+
+    # The checkpoint can only be resumed if the executables are the same
+    checkpoint.start(config, cache_keys)
+
+    # All executions (executables x backends x repetitions) are run as a flat
+    # set of jobs. Results are collected as soon as each job finishes, and
+    # are indexed by job key so they can be combined in the config order.
+    if queue_directory is None:
+        scheduler = Scheduler(jobs)
+    else:
+        scheduler = DistributedScheduler(queue_directory)
+    test_jobs = []
+    results = {}
+    references = {}
+    job_warnings = {}
+
+    # State of the backends with adaptive repetitions, which get new batches
+    # of jobs until their probes have converged
+    adaptive = {}
+
+    # Number of samples per probe expected at first
+    n_samples = 1
+
+    for i, executable in enumerate(config["executables"]):
 
         parameters = ""
         if "parameters" in executable:
             parameters = executable["parameters"]
 
-        # Backends iteration
-        for backend in executable["vfc_backends"]:
+        command = "./" + executable["executable"] + " " + parameters
+        threads = get_threads(executable)
 
-            os.putenv("VFC_BACKENDS", backend["name"])
+        # Optional limit on the number of concurrent executions of this
+        # executable
+        if "max_jobs" in executable:
+            scheduler.set_limit(i, executable["max_jobs"])
 
-            command = "./" + executable["executable"] + " " + parameters
+        for j, backend in enumerate(executable["vfc_backends"]):
 
             # By default, we expect to have a number of repetitions specified
             # to run the tests in "non-deterministic" mode.
             if "repetitions" in backend:
-                repetitions = backend["repetitions"]
-
-                run_non_deterministic(
-                    command,
-                    repetitions,
-                    executable["executable"],
-                    backend["name"],
-                    data,
-                    checks_data,
-                    warnings)
+                minimum, maximum, tolerance = get_repetitions(backend)
+                n_samples = max(n_samples, minimum)
+                keys = [
+                    ("non_deterministic", i, j, k + 1)
+                    for k in range(minimum)
+                ]
+
+                if tolerance is not None:
+                    adaptive[(i, j)] = {
+                        "command": command,
+                        "backend": backend["name"],
+                        "threads": threads,
+                        "maximum": maximum,
+                        "tolerance": tolerance,
+                        "launched": minimum,
+                        "pending": minimum,
+                        "rows": np.empty(0, dtype=np.int64)
+                    }
 
             # However, if it is not specified, we'll assume a deterministic
             # backend and fall back to this mode (so as to avoid the same data
             # processing phase used for non-deterministic mode).
             else:
-                # The run is executed in this helper function
-                run_deterministic(
-                    command,
-                    executable["executable"],
-                    backend["name"],
-                    deterministic_data,
-                    warnings)
+                keys = [("deterministic", i, j, 1)]
+
+            for key in keys:
+                job_warnings[key] = []
+                test_jobs.append(
+                    Job(key, i, command, backend["name"], timeout,
+                        threads=threads))
+
+    partition = None
+    if shard is not None:
+        total = len(test_jobs)
+        test_jobs, partition = select_shard(
+            config, test_jobs, durations_history, shard)
+
+        keys = set(job.key for job in test_jobs)
+        job_warnings = {key: [] for key in job_warnings if key in keys}
+        adaptive = {
+            group: state for group, state in adaptive.items()
+            if ("non_deterministic",) + group + (1,) in keys
+        }
 
-    # Make sure we have some data to work on
-    assert(len(data) != 0 or len(deterministic_data) != 0), "Error [vfc_ci]: No data have been generated " \
-        "by your tests executions, aborting run without writing results file"
+        print(
+            "Info [vfc_ci]: Shard %s/%s contains %s of the %s executions"
+            % (shard[0], shard[1], len(test_jobs), total)
+        )
 
-    # Combine all separate executions in one dataframe
-    if len(data) > 0:
-        data = pd.concat(data, sort=False, ignore_index=True)
-        data = data.groupby(["test", "variable", "vfc_backend"]
-                            ).values.apply(list).reset_index()
+    # The IEEE reference run of each executable with deterministic backends
+    # is shared by these backends, and runs concurrently with them
+    for job in [job for job in test_jobs if job.key[0] == "deterministic"]:
+        key = get_reference_key(job.key[1])
+        if key not in job_warnings:
+            job_warnings[key] = []
+            test_jobs.append(Job(key, job.group, job.command,
+                                 "libinterflop_ieee.so", timeout,
+                                 "reference execution", job.threads))
+
+    # Each repetition of a non-deterministic backend is given a slot in the
+    # accumulator, in the config order (new repetitions of adaptive backends
+    # get the next slots)
+    slots = {}
+    for job in test_jobs:
+        if job.key[0] == "non_deterministic":
+            slots[job.key] = len(slots)
+    accumulator = ProbesAccumulator(n_samples)
+
+    restored = []
+    executed_jobs = {}
+
+    # Tests of each non-deterministic executable/backend, so their probes can
+    # be matched to the config later on (by vfc_ci plan)
+    tests = {}
+
+    def extend_repetitions(group, rows):
+        state = adaptive[group]
+        state["rows"] = np.union1d(state["rows"], rows)
+        state["pending"] -= 1
+
+        # Wait for the whole batch before deciding to launch a new one
+        if state["pending"] > 0:
+            return
+
+        target = get_next_repetitions(
+            accumulator,
+            state["rows"],
+            state["launched"],
+            state["maximum"],
+            state["tolerance"]
+        )
 
-        data = data.set_index(
-            ["test", "variable", "vfc_backend"]).sort_index()
-        checks_data = pd.concat(
-            checks_data,
-            sort=False,
-            ignore_index=True)
-        checks_data = checks_data.drop_duplicates(
-            subset=['test', 'variable', 'vfc_backend'])
-        checks_data = checks_data.reset_index()
-        del checks_data["index"]
-        checks_data = checks_data.set_index(
-            ["test", "variable", "vfc_backend"]).sort_index()
+        keys = [
+            ("non_deterministic",) + group + (k + 1,)
+            for k in range(state["launched"], target)
+        ]
+        state["launched"] = target
+        state["pending"] = len(keys)
 
-        # Copy informations about accuracy thresholds to the main dataframe
-        data["accuracy_threshold"] = checks_data["accuracy_threshold"]
-        data["check_mode"] = checks_data["check_mode"]
+        if len(keys) > 0:
+            execution_data = get_execution_data(config, keys[0])
+            print(
+                "Info [vfc_ci]: Adding %s repetitions of %s (%s)..."
+                % (len(keys), execution_data["executable"],
+                   execution_data["backend"])
+            )
+
+        for key in keys:
+            slots[key] = len(slots)
+            job_warnings[key] = []
+            submit(Job(key, group[0], state["command"], state["backend"],
+                       timeout, threads=state["threads"]))
+
+    def collect(job, is_restored=False):
+        kind = job.key[0]
+        job_warnings.setdefault(job.key, [])
+
+        if kind == "non_deterministic":
+            rows = run_non_deterministic(
+                job, config, accumulator, slots, tests, job_warnings[job.key])
+            if job.key[1:3] in adaptive:
+                extend_repetitions(job.key[1:3], rows)
+
+        elif kind == "deterministic":
+            run_deterministic(job, config, results, job_warnings[job.key])
+        else:
+            run_reference(job, config, references, job_warnings[job.key])
+
+        # Only jobs whose probes could be read are saved, so the others
+        # will be executed again if the run is resumed
+        if not is_restored:
+            if len(job_warnings[job.key]) == 0:
+                checkpoint.save(job)
+            job.cleanup()
+
+    def submit(job):
+        executed_jobs[job.key] = job
+
+        if job.key in cached:
+            job.output_path, job.duration = cached[job.key]
+            collect(job, True)
+        elif checkpoint.restore(job):
+            restored.append(job)
+            collect(job, True)
+        else:
+            scheduler.submit(job)
+
+    test_jobs = sort_jobs(config, test_jobs, durations_history)
+    for job in test_jobs:
+        submit(job)
+
+    cached_jobs = [key for key in executed_jobs if key in cached]
+    if len(cached_jobs) > 0:
+        print(
+            "Info [vfc_ci]: %s executions have been restored from the "
+            "result cache" % len(cached_jobs)
+        )
+
+    if len(restored) > 0:
+        print(
+            "Info [vfc_ci]: %s executions have been restored from the "
+            "checkpoint" % len(restored)
+        )
+
+    if queue_directory is None:
+        print(
+            "Info [vfc_ci]: Running %s executions (up to %s concurrently)..."
+            % (len(scheduler.pending), jobs)
+        )
+    else:
+        print(
+            "Info [vfc_ci]: Sending %s executions to the workers of %s..."
+            % (len(scheduler.pending), queue_directory)
+        )
+    scheduler.run(collect)
+
+    save_cached_results(config, cache_keys, cached, checkpoint, executed_jobs)
+
+    # Backends whose results come from the cache are listed in the metadata
+    cached_results = {}
+    for key in cached_jobs:
+        execution_data = get_execution_data(config, key)
+        backends = cached_results.setdefault(
+            execution_data["executable"], [])
+        if key[0] != "reference" and execution_data["backend"] not in backends:
+            backends.append(execution_data["backend"])
+
+    # This is an array of Pandas dataframes for now
+    deterministic_data = []
+
+    # This will contain all executables/repetition numbers from which we could
+    # not get any data
+    warnings = []
+
+    # Gather results in the config order, so the output doesn't depend on the
+    # order in which jobs have finished
+    for key in sorted(job_warnings.keys(), key=lambda key: key[1:]):
+        if key[0] == "non_deterministic":
+            warnings.extend(job_warnings[key])
+
+        elif key[0] == "deterministic":
+            warnings.extend(job_warnings[key])
+
+            # Failures of the reference run are only reported (once) if it
+            # is needed
+            run_data = results[key]
+            reference_key = get_reference_key(key[1])
+            if run_data["accuracy_threshold"].sum() != 0:
+                warnings.extend(job_warnings.pop(reference_key, []))
+
+            deterministic_data.append(
+                compare_to_reference(run_data, references[key[1]]))
+
+    # Make sure we have some data to work on
+    # (shards can be empty if there are more shards than executions)
+    assert(len(slots) != 0 or len(deterministic_data) != 0
+           or shard is not None), "Error [vfc_ci]: No data have been generated " \
+        "by your tests executions, aborting run without writing results file"
 
+    # All repetitions have already been combined by the accumulator. Their
+    # samples are sorted in the config order. The ranks of samples are kept
+    # in shards, so they can be merged in this order too.
+    offsets = get_rank_offsets(config)
+    ranks = np.empty(len(slots), dtype=np.int64)
+    for key, slot in slots.items():
+        ranks[slot] = offsets[key[1:3]] + key[3] - 1
+    # Outside of shards, samples are grouped by number of samples straight
+    # from the accumulator, without copying them to a column of the dataframe
+    groups = None
+    if shard is None:
+        data = accumulator.to_dataframe(ranks, with_values=False)
+        if not data.empty:
+            groups = accumulator.group_samples(data.pop("row"), ranks)
     else:
-        data = pd.DataFrame()
+        data = accumulator.to_dataframe(ranks, with_ranks=True)
 
         # Combine all serparate executions of deterministic backends in one DF
     if len(deterministic_data) != 0:
@@ -423,7 +1060,21 @@ def run_tests(config):
     else:
         deterministic_data = pd.DataFrame()
 
-    return data, deterministic_data, warnings
+    test_jobs = [
+        job for job in executed_jobs.values() if job.key[0] != "reference"
+    ]
+
+    tests = {
+        executable: {
+            backend: sorted(backend_tests)
+            for backend, backend_tests in executable_tests.items()
+        }
+        for executable, executable_tests in tests.items()
+    }
+
+    return data, deterministic_data, warnings, \
+        get_durations(config, test_jobs), cached_results, tests, partition, \
+        groups
 
 
 def show_warnings(warnings):
@@ -455,22 +1106,37 @@ def show_warnings(warnings):
 
 ##########################################################################
 
-def run(is_git_commit, export_raw_values, dry_run):
-    '''Entry point of vfc_ci test'''
+def get_filename(metadata):
+    '''Name of the run files of a run (without extension)'''
 
-    # Get config, metadata and data
-    print("Info [vfc_ci]: Reading tests config file...")
-    config = read_config()
+    if metadata["is_git_commit"]:
+        return metadata["hash"]
+    return str(metadata["timestamp"])
 
-    print("Info [vfc_ci]: Generating run metadata...")
-    metadata = generate_metadata(is_git_commit)
 
-    data, deterministic_data, warnings = run_tests(config)
-    show_warnings(warnings)
+def export_results(
+        metadata,
+        data,
+        deterministic_data,
+        export_raw_values,
+        dry_run,
+        processing_jobs=None,
+        file_format="hdf5",
+        compress_raw_values=False,
+        database_path=None,
+        groups=None):
+    '''
+    Compute the statistics of the probes and write the run file (and raw
+    results file) in the given format (see run_files), and record it in the
+    manifest of the directory (if it has one). The run is also appended to the
+    history database, if one is specified. The samples of the probes are
+    either in the values column of data, or grouped by number of samples (see
+    data_processing).
+    '''
 
     # Data processing
     if not data.empty:
-        data = data_processing(data)
+        data = data_processing(data, processing_jobs, groups)
 
         # Link run timestamp
         data["timestamp"] = metadata["timestamp"]
@@ -480,50 +1146,60 @@ def run(is_git_commit, export_raw_values, dry_run):
             ["test", "variable", "vfc_backend"]).sort_index()
         deterministic_data["timestamp"] = metadata["timestamp"]
 
-    filename = metadata["hash"] if is_git_commit else str(
-        metadata["timestamp"])
+    filename = get_filename(metadata)
+    run_path = run_files.get_path(filename, "vfcrun", file_format)
+    raw_path = run_files.get_path(filename, "vfcraw", file_format)
 
     # Prepare metadata for export
     metadata = pd.DataFrame.from_dict([metadata])
     metadata = metadata.set_index("timestamp")
 
-    # WARNING : Exporting to HDF5 implicitly requires to install "tables" on the
-    # system
-
     if not dry_run:
         # Export raw if needed
         if export_raw_values:
-            data.to_hdf(filename + ".vfcraw.h5", key="data")
-            metadata.to_hdf(filename + ".vfcraw.h5", key="metadata")
-            deterministic_data.to_hdf(
-                filename + ".vfcraw.h5",
-                key="deterministic_data")
+            run_files.write_table(raw_path, "metadata", metadata)
+            run_files.write_table(
+                raw_path, "deterministic_data", deterministic_data)
+            run_files.write_raw_data(
+                raw_path, data, compress_raw_values, groups)
 
         # Export metadata
-        metadata.to_hdf(filename + ".vfcrun.h5", key="metadata")
+        run_files.write_table(run_path, "metadata", metadata)
 
         # Export data
-        if not data.empty:
+        if "values" in data.columns:
             del data["values"]
-        data.to_hdf(filename + ".vfcrun.h5", key="data")
+        run_files.write_table(run_path, "data", data)
 
         # Export deterministic data
-        deterministic_data.to_hdf(
-            filename + ".vfcrun.h5",
-            key="deterministic_data")
+        run_files.write_table(
+            run_path, "deterministic_data", deterministic_data)
+
+        # Record the run in the manifest of the directory, if it has one
+        manifest.add_run(run_path, metadata, data, deterministic_data)
+
+        if database_path is not None:
+            database.append_run(
+                database_path, metadata, data, deterministic_data)
 
     # Print termination messages
     print(
-        "Info [vfc_ci]: The results have been successfully written to "
-        "%s.vfcrun.h5."
-        % filename
+        "Info [vfc_ci]: The results have been successfully written to %s."
+        % run_path
     )
 
     if export_raw_values:
         print(
             "Info [vfc_ci]: A file containing the raw values has also been "
-            "created : %s.vfcraw.h5."
-            % filename
+            "created : %s."
+            % raw_path
+        )
+
+    if database_path is not None:
+        print(
+            "Info [vfc_ci]: The run has been added to the history database "
+            "%s."
+            % database_path
         )
 
     if dry_run:
@@ -531,3 +1207,122 @@ def run(is_git_commit, export_raw_values, dry_run):
             "Info [vfc_ci]: The dry run flag was enabled, so no files were "
             "actually created."
         )
+
+
+def export_shard(metadata, data, deterministic_data, shard, dry_run):
+    '''
+    Write the partial run file of a shard. Probes are not processed yet :
+    their samples and the ranks of these samples are saved, so the shards
+    can be merged (by vfc_ci merge) before computing the statistics.
+    '''
+
+    filename = "%s.shard-%s-of-%s.vfcshard.h5" \
+        % (get_filename(metadata), shard[0], shard[1])
+
+    metadata = pd.DataFrame.from_dict([metadata])
+    metadata = metadata.set_index("timestamp")
+
+    if not dry_run:
+        run_files.write_table(filename, "metadata", metadata)
+        run_files.write_table(filename, "data", data)
+        run_files.write_table(
+            filename, "deterministic_data", deterministic_data)
+
+    print(
+        "Info [vfc_ci]: The results of shard %s/%s have been successfully "
+        "written to %s. Use vfc_ci merge to combine all shards."
+        % (shard[0], shard[1], filename)
+    )
+
+    if dry_run:
+        print(
+            "Info [vfc_ci]: The dry run flag was enabled, so no files were "
+            "actually created."
+        )
+
+
+def run(
+        is_git_commit,
+        export_raw_values,
+        dry_run,
+        jobs=None,
+        history_directory=".",
+        processing_jobs=None,
+        checkpoint_directory=".vfc_ci_checkpoint",
+        resume=False,
+        use_cache=True,
+        queue_directory=None,
+        shard=None,
+        file_format="hdf5",
+        compress_raw_values=False,
+        database_path=None,
+        cache_size=cache.default_max_size):
+    '''Entry point of vfc_ci test'''
+
+    if jobs is None:
+        jobs = available_cores()
+
+    # Get config, metadata and data
+    print("Info [vfc_ci]: Reading tests config file...")
+    config = read_config()
+
+    print("Info [vfc_ci]: Generating run metadata...")
+    metadata = generate_metadata(is_git_commit)
+
+    print("Info [vfc_ci]: Reading durations of previous runs...")
+    durations_history = read_durations(history_directory)
+
+    checkpoint = Checkpoint(checkpoint_directory, resume)
+
+    data, deterministic_data, warnings, durations, cached_results, tests, \
+        partition, groups = run_tests(
+            config,
+            jobs,
+            durations_history,
+            checkpoint,
+            use_cache,
+            queue_directory,
+            shard
+        )
+    show_warnings(warnings)
+
+    # Durations are saved as a JSON string so they can be used to schedule
+    # the next runs
+    metadata["durations"] = json.dumps(durations)
+
+    # Backends whose results have been reused from a previous run
+    metadata["cached"] = json.dumps(cached_results)
+
+    # Tests of each non-deterministic executable/backend
+    metadata["tests"] = json.dumps(tests)
+
+    if shard is None:
+        export_results(
+            metadata,
+            data,
+            deterministic_data,
+            export_raw_values,
+            dry_run,
+            processing_jobs,
+            file_format,
+            compress_raw_values,
+            database_path,
+            groups
+        )
+
+    else:
+        # Shards can only be merged if they come from the same config, and
+        # the same partition of the jobs
+        metadata["shard"] = json.dumps({
+            "index": shard[0],
+            "count": shard[1],
+            "config": cache.hash_key(config),
+            "partition": partition
+        })
+        export_shard(metadata, data, deterministic_data, shard, dry_run)
+
+    # The run is complete, so its checkpoint isn't needed anymore
+    checkpoint.remove()
+
+    # Cached probes are read in place, so the cache is only pruned now
+    cache.prune(cache_size)
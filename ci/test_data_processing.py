@@ -22,159 +22,504 @@
 #                                                                           #
 #############################################################################
 
-import verificarlo.sigdigits as sd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from functools import lru_cache
+
 import scipy.stats
+
+import verificarlo.sigdigits as sd
 import numpy as np
 
+from .normality import shapiro_pvalues
+
 # Magic numbers
 # For the normality test :
 min_pvalue = 0.05
 probability = 0.9
 confidence = 0.95
 
+# Metrics computed for each distribution (in the order of the rows of the
+# shared output buffer when processing in parallel)
+metrics_columns = [
+    "mu", "sigma", "pvalue", "min",
+    "quantile25", "quantile50", "quantile75", "max",
+    "s2", "s2_lower_bound"
+]
+
+# Matrices with fewer samples than this are always processed in the main
+# process, since starting workers would take longer than processing them
+min_parallel_samples = 10**6
+
+# In the main process, matrices are processed by chunks of rows of at most
+# this number of samples, so temporary arrays stay small
+max_chunk_samples = 10**6
+
+# Each worker gets several chunks of rows, because degenerate distributions
+# are much faster to process than the others
+chunks_per_job = 4
+
 
 ##########################################################################
 
-def significant_digits(x):
-    '''First wrapper to sd.significant_digits (returns results in base 2)'''
+def deduplicate(matrix):
+    '''
+    Remove the identical rows (same bytes, which is the case for integer
+    counters across backends for instance) of a (distributions x samples)
+    matrix. Returns the matrix of unique rows, and the row of each original
+    row in this matrix.
+    '''
+
+    # Each row is viewed as a single opaque item, so rows are compared on
+    # their content
+    keys = np.ascontiguousarray(matrix).view(
+        np.dtype((np.void, matrix.itemsize * matrix.shape[1]))).ravel()
+    _, unique, inverse = np.unique(
+        keys, return_index=True, return_inverse=True)
+
+    return matrix[unique], inverse.ravel()
+
+
+def group_by_nsamples(values):
+    '''
+    Group distributions by number of samples. Returns a dict associating each
+    number of samples to the positions of its distributions, to a
+    (distributions x samples) matrix and to the row of each position in this
+    matrix.
+    Identical distributions are only stored once in the matrix (see
+    deduplicate), so their metrics are only computed once.
+    '''
+
+    nsamples = np.array([len(x) for x in values])
+    groups = {}
+
+    for n in np.unique(nsamples):
+        rows = np.flatnonzero(nsamples == n)
+        matrix = np.vstack([values[i] for i in rows]).astype(np.float64)
+
+        groups[n] = (rows,) + deduplicate(matrix)
+
+    return groups
+
+
+def find_degenerate(minimum, maximum):
+    '''
+    Find constant distributions, and near-constant distributions whose samples
+    are all within one ulp of each other. Precision can't be estimated beyond
+    the 53 bits of a double for these, so they don't need to go through the
+    normality test and the sigdigits estimators.
+    '''
+
+    spread = maximum - minimum
+    magnitude = np.maximum(np.absolute(minimum), np.absolute(maximum))
 
-    if x.mu == 0:
-        return 53
+    return spread <= magnitude * 2**-52
+
+
+def validate_checks(check_mode, accuracy_threshold, mu, sigma):
+    '''
+    Validate the checks of all non-deterministic probes at once, depending on
+    if they are absolute or relative
+    '''
+
+    threshold = np.absolute(accuracy_threshold)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_error = np.absolute(sigma / mu)
+
+    return np.where(
+        check_mode == "absolute",
+        sigma < threshold,
+        np.where(check_mode == "relative", relative_error < threshold, True)
+    )
+
+
+def compute_statistics(distributions):
+    '''
+    This function computes most test metrics (mu, sigma, quantiles, ...) of a
+    (distributions x samples) matrix. Doesn't include significant digits.
+    Each metric is computed with a single array operation for the whole
+    matrix. Constant distributions get their value as mu and a sigma of 0,
+    and degenerate ones aren't tested for normality.
+    '''
+
+    results = {}
+
+    # Quantiles
+    quantiles = np.quantile(distributions, [0.25, 0.50, 0.75], axis=1)
+    results["min"] = np.min(distributions, axis=1)
+    results["quantile25"] = quantiles[0]
+    results["quantile50"] = quantiles[1]
+    results["quantile75"] = quantiles[2]
+    results["max"] = np.max(distributions, axis=1)
+
+    constant = results["min"] == results["max"]
+    degenerate = find_degenerate(results["min"], results["max"])
+
+    # Get empirical average, standard deviation and p-value
+    results["mu"] = np.average(distributions, axis=1)
+    results["sigma"] = np.std(distributions, axis=1)
+    results["mu"][constant] = results["min"][constant]
+    results["sigma"][constant] = 0
+
+    results["pvalue"] = np.ones(len(distributions))
+    if not degenerate.all():
+        results["pvalue"][~degenerate] = shapiro_pvalues(
+            distributions[~degenerate])
+
+    return results, degenerate
+
+
+def significant_digits(distributions, mu, sigma, pvalue, degenerate):
+    '''
+    Computes the significant digits (s2) and the lower bound of their
+    confidence interval (s2_lower_bound) in base 2, with the sigdigits module,
+    for a (distributions x samples) matrix.
+    The General and CNH estimators are called only once on a
+    (samples x distributions) matrix, with the vector of the empirical
+    averages as references.
+    '''
+
+    # If the average is 0, or if the distribution is degenerate, the relative
+    # precision is maximal
+    s2 = np.full(len(distributions), 53.0)
+    s2_lower_bound = np.full(len(distributions), 53.0)
 
     # If the null hypothesis is rejected, call sigdigits with the General
-    # formula:
-    if x.pvalue < min_pvalue:
-        # In a pandas DF, "values" actually refers to the array of columns, and
-        # not the column named "values"
-        distribution = x.values[0]
-        distribution = distribution.reshape(len(distribution), 1)
+    # formula (there is no lower bound in this case)
+    general = ~degenerate & (mu != 0) & (pvalue < min_pvalue)
+
+    # Else, manually compute sMCA (Stott-Parker formula), and compute the
+    # lower bound with the CNH formula
+    cnh = ~degenerate & (mu != 0) & ~(pvalue < min_pvalue)
+
+    with np.errstate(divide="ignore"):
+        s2[cnh] = np.minimum(-np.log2(np.absolute(sigma[cnh] / mu[cnh])), 53)
 
-        # The distribution's empirical average will be used as the reference
-        mu = np.array([x.mu])
+    for mask, method in [(general, sd.Method.General), (cnh, sd.Method.CNH)]:
+        if not mask.any():
+            continue
 
+        # Samples are passed as columns (the transposed matrix is
+        # column-major, so each distribution stays contiguous)
         s = sd.significant_digits(
-            distribution,
-            mu,
+            distributions[mask].T,
+            mu[mask],
             precision=sd.Precision.Relative,
-            method=sd.Method.General,
+            method=method,
 
             probability=probability,
             confidence=confidence
         )
 
-        # s is returned inside a list
-        return s[0]
+        if method == sd.Method.General:
+            s2[mask] = s
+        else:
+            s2_lower_bound[mask] = s
 
-    # Else, manually compute sMCA (Stott-Parker formula)
-    else:
-        return min(-np.log2(np.absolute(x.sigma / x.mu)), 53)
+    s2_lower_bound[general] = s2[general]
 
+    return s2, s2_lower_bound
 
-def significant_digits_lower_bound(x):
+
+def process_distributions(distributions):
     '''
-    Second wrapper to sd.significant_digits : assumes that s2 has already been
-    computed
+    Computes all the metrics of a (distributions x samples) matrix. Returns a
+    dict associating each column of metrics_columns to an array.
     '''
 
-    # If the null hypothesis is rejected, no lower bound
-    if x.pvalue < min_pvalue:
-        return x.s2
+    # Computes most of test metrics
+    metrics, degenerate = compute_statistics(distributions)
 
-    elif x.mu == 0:
-        return 53
+    # Significant digits, and lower bound of the confidence interval using
+    # the sigdigits module
+    metrics["s2"], metrics["s2_lower_bound"] = significant_digits(
+        distributions,
+        metrics["mu"],
+        metrics["sigma"],
+        metrics["pvalue"],
+        degenerate
+    )
 
-    # Else, the lower bound will be computed with p= .9 alpha-1=.95
-    else:
-        distribution = x.values[0]
-        distribution = distribution.reshape(len(distribution), 1)
+    return metrics
 
-        mu = np.array([x.mu])
 
-        s = sd.significant_digits(
-            distribution,
-            mu,
-            precision=sd.Precision.Relative,
-            method=sd.Method.CNH,
+def process_distributions_by_chunks(distributions):
+    '''
+    Same as process_distributions, but rows are processed by chunks of at most
+    max_chunk_samples samples
+    '''
 
-            probability=0.9,
-            confidence=0.95
-        )
-        return s[0]
+    n_rows, n = distributions.shape
+    chunk_rows = max(1, max_chunk_samples // max(n, 1))
+    if n_rows <= chunk_rows:
+        return process_distributions(distributions)
 
+    metrics = {column: np.empty(n_rows) for column in metrics_columns}
+    for start in range(0, n_rows, chunk_rows):
+        chunk_metrics = process_distributions(
+            distributions[start:start + chunk_rows])
+        for column in metrics_columns:
+            metrics[column][start:start + chunk_rows] = chunk_metrics[column]
 
-def apply_data_pocessing(data):
+    return metrics
+
+
+def process_shared_distributions(
+        input_name, output_name, shape, start, stop):
     '''
-    This function computes most test metrics (mu, sigma, quantiles, ...).
-    Doesn't include significant digits.
+    Worker function of the process pool: computes the metrics of rows
+    start:stop of a (distributions x samples) matrix stored in the
+    input_name shared memory block, and writes them to the
+    (metrics x distributions) matrix of the output_name block.
     '''
 
-    # Get empirical average, standard deviation and p-value
-    data["mu"] = np.average(data["values"])
-    data["sigma"] = np.std(data["values"])
-    data["pvalue"] = scipy.stats.shapiro(data["values"]).pvalue
-
-    # Quantiles
-    data["min"] = np.min(data["values"])
-    data["quantile25"] = np.quantile(data["values"], 0.25)
-    data["quantile50"] = np.quantile(data["values"], 0.50)
-    data["quantile75"] = np.quantile(data["values"], 0.75)
-    data["max"] = np.max(data["values"])
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
 
-    # Check validation
+    try:
+        distributions = np.ndarray(
+            shape, dtype=np.float64, buffer=input_memory.buf)
+        output = np.ndarray(
+            (len(metrics_columns), shape[0]),
+            dtype=np.float64,
+            buffer=output_memory.buf)
 
-    if data["check_mode"] == "absolute":
-        data["check"] = True if data["sigma"] < abs(
-            data["accuracy_threshold"]) else False
+        metrics = process_distributions(distributions[start:stop])
+        for i, column in enumerate(metrics_columns):
+            output[i, start:stop] = metrics[column]
 
-    elif data["check_mode"] == "relative":
-        data["check"] = True if abs(
-            data["sigma"] /
-            data["mu"]) < abs(data["accuracy_threshold"]) else False
+        # Views have to be released before closing the shared memory
+        del distributions, output
 
-    else:
-        data["check"] = True
+    finally:
+        input_memory.close()
+        output_memory.close()
 
-    return data
 
+def process_distributions_in_parallel(distributions, executor, jobs):
+    '''
+    Same as process_distributions, but the rows of the matrix are split
+    between the workers of executor. The matrix and the results are
+    exchanged through shared memory instead of being pickled.
+    '''
 
-def data_processing(data):
+    n_rows = distributions.shape[0]
+    input_memory = shared_memory.SharedMemory(
+        create=True, size=distributions.nbytes)
+    output_memory = shared_memory.SharedMemory(
+        create=True, size=len(metrics_columns) * n_rows * 8)
+
+    try:
+        shared = np.ndarray(
+            distributions.shape, dtype=np.float64, buffer=input_memory.buf)
+        shared[:] = distributions
+
+        bounds = np.linspace(
+            0, n_rows, min(n_rows, jobs * chunks_per_job) + 1).astype(int)
+        futures = [
+            executor.submit(
+                process_shared_distributions,
+                input_memory.name,
+                output_memory.name,
+                distributions.shape,
+                start,
+                stop
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        for future in futures:
+            future.result()
+
+        output = np.ndarray(
+            (len(metrics_columns), n_rows),
+            dtype=np.float64,
+            buffer=output_memory.buf)
+        metrics = {
+            column: output[i].copy()
+            for i, column in enumerate(metrics_columns)
+        }
+
+        del shared, output
+
+    finally:
+        input_memory.close()
+        input_memory.unlink()
+        output_memory.close()
+        output_memory.unlink()
+
+    return metrics
+
+
+def data_processing(data, jobs=None, groups=None):
     '''
-    Computes all metrics on the dataframe
+    Computes all metrics on the dataframe. The samples of the probes are
+    either in the values column, or already grouped by number of samples
+    (groups, as returned by group_by_nsamples, indexed by the positions of the
+    probes in the dataframe). If jobs is greater than 1, large groups of
+    distributions are processed by a pool of jobs processes.
     '''
 
-    # Converts classic lists to Numpy arrays
-    data["values"] = data["values"].apply(lambda x: np.array(x))
+    if groups is None:
+        groups = group_by_nsamples(data["values"].to_numpy())
 
-    # Computes most of test metrics
-    data = data.apply(apply_data_pocessing, axis=1)
+    results = {column: np.empty(len(data)) for column in metrics_columns}
+
+    parallel = jobs is not None and jobs > 1 and any(
+        distributions.size >= min_parallel_samples
+        for rows, distributions, inverse in groups.values()
+    )
+    executor = ProcessPoolExecutor(max_workers=jobs) if parallel else None
+
+    try:
+        for n, (rows, distributions, inverse) in groups.items():
+            if parallel and distributions.size >= min_parallel_samples:
+                metrics = process_distributions_in_parallel(
+                    distributions, executor, jobs)
+            else:
+                metrics = process_distributions_by_chunks(distributions)
+
+            # Identical distributions share the same metrics. Results are
+            # scattered back to the positions of their probes, so the
+            # original order of the dataframe is kept.
+            for column in metrics_columns:
+                results[column][rows] = metrics[column][inverse]
 
-    # Significant digits
-    data["s2"] = data.apply(significant_digits, axis=1)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for column in metrics_columns[:8]:
+        data[column] = results[column]
+
+    # Check validation
+    data["check"] = validate_checks(
+        data["check_mode"].to_numpy(),
+        data["accuracy_threshold"].to_numpy(dtype=np.float64),
+        results["mu"],
+        results["sigma"]
+    )
+
+    data["s2"] = results["s2"]
     data["s10"] = data["s2"].apply(lambda x: sd.change_base(x, 10))
 
-    # Lower bound of the confidence interval using the sigdigits module
-    data["s2_lower_bound"] = data.apply(significant_digits_lower_bound, axis=1)
+    data["s2_lower_bound"] = results["s2_lower_bound"]
     data["s10_lower_bound"] = data["s2_lower_bound"].apply(
         lambda x: sd.change_base(x, 10))
 
-    data["nsamples"] = data["values"].apply(len)
+    nsamples = np.empty(len(data), dtype=np.int64)
+    for n, (rows, distributions, inverse) in groups.items():
+        nsamples[rows] = n
+    data["nsamples"] = nsamples
 
     return data
 
 
-def validate_deterministic_probe(x):
+@lru_cache(maxsize=None)
+def general_samples():
+    '''
+    Number of samples needed by the General formula of sigdigits to estimate
+    the significant digits with the configured probability and confidence
+    '''
+
+    return int(np.ceil(np.log(1 - confidence) / np.log(probability)))
+
+
+def cnh_width(n):
+    '''
+    Width (in bits) of the part of the CNH confidence interval due to the
+    estimation of sigma from n samples : how much the lower bound of the
+    significant digits would increase with an infinite number of samples
+    '''
+
+    degrees = n - 1
+    return 0.5 * np.log2(
+        degrees / scipy.stats.chi2.ppf(1 - confidence, degrees))
+
+
+@lru_cache(maxsize=None)
+def cnh_samples(tolerance):
+    '''
+    Smallest number of samples for which the width of the CNH confidence
+    interval is under tolerance (in bits)
+    '''
+
+    high = 2
+    while cnh_width(high) > tolerance:
+        high *= 2
+
+    # The width is decreasing with n
+    low = max(high // 2, 2)
+    while low < high:
+        middle = (low + high) // 2
+        if cnh_width(middle) > tolerance:
+            low = middle + 1
+        else:
+            high = middle
+
+    return high
+
+
+def needed_samples(mu, pvalue, degenerate, tolerance):
     '''
-    This function will be applied to results dataframes of deterministic
-    backends to validate probes depending on if they are absolute or relative
+    Number of samples needed by distributions (described by their metrics) so
+    that their significant digits are known with the given tolerance (in
+    bits), depending on how they are estimated. The metrics only select the
+    estimator : its bound doesn't depend on sigma. Degenerate distributions
+    and distributions with a zero average don't need any particular number of
+    samples (0).
     '''
 
-    if x["check_mode"] == "absolute":
-        return True if abs(
-            x["value"] -
-            x["reference_value"]) < abs(x["accuracy_threshold"]) else False
+    needed = np.zeros(len(mu), dtype=np.int64)
+
+    general = ~degenerate & (mu != 0) & (pvalue < min_pvalue)
+    cnh = ~degenerate & (mu != 0) & ~(pvalue < min_pvalue)
+
+    needed[general] = general_samples()
+    needed[cnh] = cnh_samples(tolerance)
+
+    return needed
 
-    if x["check_mode"] == "relative":
-        return True if abs(x["value"] - x["reference_value"]) / \
-            abs(x["reference_value"]) < abs(x["accuracy_threshold"]) else False
 
-    return True
+def required_samples(distributions, tolerance):
+    '''
+    Number of samples needed by each distribution of a
+    (distributions x samples) matrix (at least its current number of
+    samples), according to needed_samples
+    '''
+
+    metrics, degenerate = compute_statistics(distributions)
+
+    return np.maximum(
+        distributions.shape[1],
+        needed_samples(
+            metrics["mu"], metrics["pvalue"], degenerate, tolerance)
+    )
+
+
+def validate_deterministic_checks(
+        check_mode, accuracy_threshold, value, reference_value):
+    '''
+    Validate the checks of all deterministic probes at once, by comparing
+    their values to the reference ones. The relative error to a reference
+    value of 0 is 0 if the value is 0 too, and infinite otherwise. Probes
+    without a reference value fail their checks.
+    '''
+
+    threshold = np.absolute(accuracy_threshold)
+    absolute_error = np.absolute(value - reference_value)
+
+    zero = reference_value == 0
+    relative_error = np.where(zero, np.where(value == 0, 0, np.inf), 1.0)
+    np.divide(
+        absolute_error,
+        np.absolute(reference_value),
+        out=relative_error,
+        where=~zero
+    )
+
+    return np.where(
+        check_mode == "absolute",
+        absolute_error < threshold,
+        np.where(check_mode == "relative", relative_error < threshold, True)
+    )
@@ -23,7 +23,8 @@
 #############################################################################
 
 # Look for and read all the run files in the current directory (ending with
-# .vfcrun.h5), and lanch a Bokeh server for the visualization of this data.
+# .vfcrun.h5 or .vfcrun.parquet), and lanch a Bokeh server for the
+# visualization of this data.
 
 import os
 import sys
@@ -44,6 +45,10 @@ import checks
 
 import helper
 
+# Run files and history databases are read with the same functions as vfc_ci
+from verificarlo.ci import run_files, manifest as runs_manifest, \
+    database as history_database
+
 ##########################################################################
 
 
@@ -60,6 +65,8 @@ directory = "."
 max_files = 100
 ignore_recent = 0
 
+database = None
+
 for i in range(1, len(sys.argv)):
 
     # Look for a logo URL
@@ -80,6 +87,10 @@ for i in range(1, len(sys.argv)):
     if sys.argv[i] == "ignore_recent":
         ignore_recent = int(sys.argv[i + 1])
 
+    # Runs can be read from a history database instead of run files
+    if sys.argv[i] == "database":
+        database = sys.argv[i + 1]
+
 
 curdoc().template_variables["has_logo"] = has_logo
 
@@ -89,25 +100,108 @@ curdoc().template_variables["has_logo"] = has_logo
 
 # Read vfcrun files, and aggregate them in one dataset
 
-run_files = [f for f in os.listdir(directory) if f.endswith(".vfcrun.h5")]
+# Columns used by the views (in Parquet run files, the other columns are not
+# read at all)
+data_columns = [
+    "sigma", "s10", "s2", "s10_lower_bound", "s2_lower_bound",
+    "mu", "pvalue", "min", "quantile25", "quantile50", "quantile75", "max",
+    "nsamples", "accuracy_threshold", "check", "check_mode", "timestamp"
+]
+deterministic_data_columns = [
+    "value", "accuracy_threshold", "reference_value", "check", "check_mode",
+    "timestamp"
+]
+
+
+def select_runs(timestamps):
+    '''
+    Select the timestamps of the runs to load : the ignore_recent most recent
+    runs are ignored, and max_files runs are kept
+    '''
+
+    timestamps = sorted(timestamps)
+
+    if ignore_recent != 0:
+        timestamps = timestamps[:-ignore_recent]
+
+    return timestamps[:max_files]
 
-if len(run_files) == 0:
-    print(
-        "Warning [vfc_ci]: Could not find any vfcrun files in the directory. "
-        "This will result in server errors and prevent you from viewing the report.")
 
 # These are arrays of Pandas dataframes for now
 metadata = []
 data = []
 deterministic_data = []
 
-# First pass for metadata
-for f in run_files:
-    path = os.path.normpath(directory + "/" + f)
-    metadata.append(pd.read_hdf(path, "metadata"))
-    current_metadata = pd.read_hdf(path, "metadata")
+if database is None:
+    names = [f for f in os.listdir(directory) if run_files.is_run_file(f)]
+
+    if len(names) == 0:
+        print(
+            "Warning [vfc_ci]: Could not find any vfcrun files in the directory. "
+            "This will result in server errors and prevent you from viewing the report.")
+
+    # Timestamps of the runs are read from the manifest, so only the files of
+    # the selected runs are opened. The metadata of run files that are missing
+    # from the manifest (or whose size or modification time has changed since
+    # their entry was written) is read from the files.
+    manifest = runs_manifest.read(directory)
+    timestamps = {}
+    files_metadata = {}
+
+    for f in names:
+        path = os.path.normpath(directory + "/" + f)
+        if f in manifest and runs_manifest.is_current(manifest[f], path):
+            timestamps[f] = manifest[f]["timestamp"]
+        else:
+            files_metadata[f] = run_files.read_table(path, "metadata")
+            timestamps[f] = files_metadata[f].iloc[0].name
 
-metadata = pd.concat(metadata).sort_index()
+    if len(manifest) != 0 and len(files_metadata) != 0:
+        print(
+            "Warning [vfc_ci]: %s run files are missing from the manifest of "
+            "the directory, or have changed since it was written. Use vfc_ci "
+            "reindex to update it." % len(files_metadata), file=sys.stderr)
+
+    selected_timestamps = set(select_runs(timestamps.values()))
+
+    for f in names:
+        if timestamps[f] not in selected_timestamps:
+            continue
+
+        path = os.path.normpath(directory + "/" + f)
+        if f in files_metadata:
+            metadata.append(files_metadata[f])
+        else:
+            metadata.append(run_files.read_table(path, "metadata"))
+
+        data.append(run_files.read_table(path, "data", data_columns))
+        deterministic_data.append(
+            run_files.read_table(
+                path,
+                "deterministic_data",
+                deterministic_data_columns))
+
+    metadata = pd.concat(metadata).sort_index() if len(metadata) != 0 \
+        else pd.DataFrame()
+
+else:
+    import sqlite3
+
+    # The metadata of all runs are in the runs table
+    connection = sqlite3.connect(database)
+    metadata = history_database.read_table(connection, "metadata")
+    metadata = metadata.loc[select_runs(metadata.index)]
+
+    # Probes of the selected runs are found with the timestamp index
+    if len(metadata) != 0:
+        max_timestamp = int(metadata.index.max())
+        data.append(history_database.read_table(
+            connection, "data", data_columns, "WHERE timestamp <= ?",
+            (max_timestamp,)))
+        deterministic_data.append(history_database.read_table(
+            connection, "deterministic_data", deterministic_data_columns,
+            "WHERE timestamp <= ?", (max_timestamp,)))
+    connection.close()
 
 if len(metadata) == 0:
     print(
@@ -116,42 +210,10 @@ if len(metadata) == 0:
         "If you did not expect this, make sure that you have correctly "
         "specified the directory containing the run files.", file=sys.stderr)
 
-
-# Sort and filter metadata
-
-metadata.sort_index()
-
-# Ignore the most recent files if needed
-if ignore_recent != 0:
-    metadata.drop(metadata.tail(ignore_recent).index, inplace=True)
-
-# max_files will equal the actual dataframe size if its smaller than the
-# original value
-max_files = min(max_files, len(metadata))
-
-metadata = metadata.head(max_files)
-
-# Maximal acceptable timestamp
-max_timestamp = metadata.iloc[max_files - 1].name
-
-# Second pass for data (now that we know which files to load entirely)
-for f in run_files:
-
-    # We have to read the metadata again to get back the timestamp.
-    # Then, depending of the timestamp value, data will be read or dismissed
-    path = os.path.normpath(directory + "/" + f)
-    current_metadata = pd.read_hdf(path, "metadata")
-    current_timestamp = current_metadata.iloc[0].name
-
-    if current_timestamp <= max_timestamp:
-        data.append(pd.read_hdf(directory + "/" + f, "data"))
-        deterministic_data.append(
-            pd.read_hdf(
-                directory + "/" + f,
-                "deterministic_data"))
-
-data = pd.concat(data).sort_index()
-deterministic_data = pd.concat(deterministic_data).sort_index()
+data = pd.concat(data).sort_index() if len(data) != 0 \
+    else pd.DataFrame()
+deterministic_data = pd.concat(deterministic_data).sort_index() \
+    if len(deterministic_data) != 0 else pd.DataFrame()
 
 # If no data/deterministic_data has been found, create an empty dataframe anyway
 # (with column names) to avoid errors further in the code
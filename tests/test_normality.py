@@ -0,0 +1,106 @@
+#############################################################################
+#                                                                           #
+#  This file is part of Verificarlo.                                        #
+#                                                                           #
+#  Copyright (c) 2015-2021                                                  #
+#     Verificarlo contributors                                              #
+#     Universite de Versailles St-Quentin-en-Yvelines                       #
+#     CMLA, Ecole Normale Superieure de Cachan                              #
+#                                                                           #
+#  Verificarlo is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU General Public License as published by     #
+#  the Free Software Foundation, either version 3 of the License, or        #
+#  (at your option) any later version.                                      #
+#                                                                           #
+#  Verificarlo is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#  GNU General Public License for more details.                             #
+#                                                                           #
+#  You should have received a copy of the GNU General Public License        #
+#  along with Verificarlo.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                           #
+#############################################################################
+
+# Regression tests of the vectorized Shapiro-Wilk test (ci/normality.py) :
+# its p-values must match the ones of scipy.stats.shapiro, probe by probe.
+
+import warnings
+
+import numpy as np
+import pytest
+import scipy.stats
+
+from ci.normality import shapiro_pvalues
+
+
+def scipy_pvalues(distributions):
+    with warnings.catch_warnings():
+        # scipy warns about constant rows and very large samples
+        warnings.simplefilter("ignore")
+        return np.array([
+            scipy.stats.shapiro(row).pvalue for row in distributions
+        ])
+
+
+def check(distributions):
+    np.testing.assert_allclose(
+        shapiro_pvalues(distributions),
+        scipy_pvalues(distributions),
+        rtol=1e-7,
+        atol=1e-12
+    )
+
+
+@pytest.mark.parametrize("n", range(3, 51))
+def test_small_samples(n):
+    rng = np.random.default_rng(n)
+    distributions = np.concatenate([
+        rng.normal(size=(20, n)),
+        rng.exponential(size=(20, n)),
+        rng.uniform(size=(20, n)) * 1e-10 + 1.0
+    ])
+
+    check(distributions)
+
+
+@pytest.mark.parametrize("n", [1000, 5000, 6000])
+def test_large_samples(n):
+    rng = np.random.default_rng(n)
+    distributions = np.concatenate([
+        rng.normal(size=(3, n)),
+        rng.standard_t(3, size=(3, n))
+    ])
+
+    check(distributions)
+
+
+@pytest.mark.parametrize("n", [3, 4, 7, 12, 30])
+def test_ties(n):
+    rng = np.random.default_rng(n)
+    distributions = np.round(rng.normal(size=(30, n)), 1)
+
+    # Two distinct values only
+    distributions[0] = 0.0
+    distributions[0, 0] = 1.0
+
+    check(distributions)
+
+
+@pytest.mark.parametrize("n", [3, 5, 20])
+def test_near_constant(n):
+    rng = np.random.default_rng(n)
+    base = rng.normal(size=(10, 1)) * 1e3
+
+    # Constant rows, and rows varying in their last bits
+    distributions = np.concatenate([
+        np.repeat(base, n, axis=1),
+        base + base * np.finfo(np.float64).eps * rng.integers(-2, 3, (10, n))
+    ])
+
+    check(distributions)
+
+
+def test_too_few_samples():
+    with pytest.raises(ValueError):
+        shapiro_pvalues(np.zeros((2, 2)))